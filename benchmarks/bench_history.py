@@ -0,0 +1,115 @@
+"""
+Микробенчмарк сборки contents для Gemini: глубокое копирование истории против кольцевого буфера.
+
+Запуск: python benchmarks/bench_history.py [--sessions 10000] [--requests 20000]
+"""
+import argparse
+import copy
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# main.py пишет лог и файлы кэшей в текущий каталог
+os.environ.setdefault("SESSION_BACKEND", "memory")
+os.chdir(tempfile.mkdtemp(prefix="bench_history_"))
+
+import main  # noqa: E402
+
+MAX_HISTORY_LENGTH = 10  # прежний предел истории, одинаковый для обоих вариантов
+QUESTION = "Что мне лучше съесть на ужин, если днем был творог с морковным салатом?"
+ANSWER = ("Рекомендую легкий ужин: тушеные овощи с семенами и кусочек запеченной рыбы. " * 30)[:2500]
+
+
+def legacy_trim(history):
+    if len(history) <= MAX_HISTORY_LENGTH + 1:
+        return history
+    return [history[0]] + history[-MAX_HISTORY_LENGTH:]
+
+
+def legacy_session(system_prompt):
+    history = [{"role": "user", "parts": [{"text": system_prompt}]}]
+    for _ in range(MAX_HISTORY_LENGTH // 2):
+        history.append({"role": "user", "parts": [{"text": QUESTION}]})
+        history.append({"role": "model", "parts": [{"text": ANSWER}]})
+    return {"history": history}
+
+
+def legacy_request(session, user_input, answer):
+    history = copy.deepcopy(session["history"])
+    history = legacy_trim(history)
+    history.append({"role": "user", "parts": [{"text": user_input}]})
+    body = {"contents": history}
+
+    session["history"].append({"role": "user", "parts": [{"text": user_input}]})
+    session["history"].append({"role": "model", "parts": [{"text": answer}]})
+    session["history"] = legacy_trim(session["history"])
+    return body
+
+
+def ring_session(system_turn):
+    history = main.ConversationHistory(system_turn, maxlen=MAX_HISTORY_LENGTH)
+    for _ in range(MAX_HISTORY_LENGTH // 2):
+        history.append(main.Turn("user", QUESTION))
+        history.append(main.Turn("model", ANSWER))
+    return history
+
+
+def ring_request(history, user_input, answer):
+    user_turn = main.Turn("user", user_input)
+    body = {"contents": history.contents(user_turn.content)}
+
+    history.append(user_turn)
+    history.append(main.Turn("model", answer))
+    return body
+
+
+def measure(name, sessions, request, order):
+    # Пиковое выделение памяти внутри одного запроса
+    tracemalloc.start()
+    transient = 0
+    for index in order:
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        request(sessions[index], QUESTION, ANSWER)
+        _, peak = tracemalloc.get_traced_memory()
+        transient += peak - current
+    tracemalloc.stop()
+
+    # Время без накладных расходов tracemalloc
+    started = time.perf_counter()
+    for index in order:
+        request(sessions[index], QUESTION, ANSWER)
+    cpu = time.perf_counter() - started
+
+    count = len(order)
+    print(f"{name:>8}: {cpu / count * 1e6:8.1f} мкс/запрос, {transient / count:8.0f} Б выделяется на запрос")
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+
+    system_prompt = main.get_system_prompt_with_date()
+    system_turn = main.Turn("user", system_prompt)
+    rng = random.Random(42)
+    order = [rng.randrange(args.sessions) for _ in range(args.requests)]
+
+    print(f"Сессий: {args.sessions}, запросов: {args.requests}, системный промпт: {len(system_prompt)} символов")
+    legacy = [legacy_session(system_prompt) for _ in range(args.sessions)]
+    measure("deepcopy", legacy, legacy_request, order)
+    del legacy
+
+    ring = [ring_session(system_turn) for _ in range(args.sessions)]
+    measure("ring", ring, ring_request, order)
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,480 @@
+"""
+Нагрузочный тест настоящих обработчиков бота против локальных заглушек Bot API и Gemini.
+
+Заглушки работают в отдельном процессе (tornado), задержки и ошибки задаются распределениями,
+сценарии пользователей детерминированы через --seed. Отчет: p50/p95/p99 по типам действий,
+пропускная способность и память.
+
+Запуск: python benchmarks/bench_load.py [--users 50] [--actions 10] [--gemini-latency 0.8]
+        [--set GEMINI_STREAMING=0 ...] [--json results.json] [--fail-p95 5]
+"""
+import argparse
+import asyncio
+import hashlib
+import importlib
+import io
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+import tornado.web
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# main.py импортируется только после настройки окружения (см. run_bench):
+# этот модуль заново импортирует и процесс заглушек, которому бот не нужен
+BENCH_ENV = {
+    "TELEGRAM_BOT_TOKEN": "0:bench",
+    "GEMINI_API_KEY": "bench-key-0000000000",
+    "SESSION_BACKEND": "memory",
+    "GEMINI_CONTEXT_CACHE": "0",
+    "WARMUP_ENABLED": "0",
+    "METRICS_ENABLED": "0",
+    "LOG_LEVEL": "WARNING",
+}
+KINDS = ("text", "button", "photo")
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+TEXTS = [
+    "Что на обед?",
+    "Какие продукты содержат цинк?",
+    "Можно ли мне свеклу?",
+    "Сколько воды пить?",
+    "Что мне лучше съесть на ужин, если днем был творог с морковным салатом?",
+    "Подскажите, как совместить прогулки и упражнения для спины при моих проблемах с позвоночником?",
+    "Съел на завтрак овсянку с орехами и выпил чай с медом",
+    "Можно ли мне иногда есть шоколад, если очень хочется сладкого?",
+]
+WORDS = ("овощи", "рыба", "белок", "витамины", "порция", "тушеные", "салат", "вода", "прогулка", "орехи")
+
+
+# =====================================================================
+# ЗАГЛУШКИ BOT API И GEMINI (отдельный процесс)
+# =====================================================================
+
+class FakeState:
+    """Общие для заглушек счетчики и параметры распределений"""
+
+    def __init__(self, config):
+        self.config = config
+        self.message_ids = itertools.count(1000)
+        self.photos = {}
+        self.cached_contents = set()  # имена созданных cachedContents
+        self.occurrences = Counter()  # отпечаток запроса -> сколько раз он приходил
+
+    def request_rng(self, *key):
+        """Генератор случайных чисел для запроса: от seed, содержимого запроса и номера его повтора
+
+        Задержка, 503/429 и текст ответа не зависят от того, в каком порядке пришли запросы
+        разных пользователей. Порядок важен только среди одинаковых запросов, а они взаимозаменяемы.
+        """
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        self.occurrences[digest] += 1
+        return random.Random(f"{self.config['seed']}:{digest}:{self.occurrences[digest]}")
+
+    @staticmethod
+    def delay(rng, median, sigma):
+        return rng.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+
+    def answer(self, rng):
+        words = []
+        size = 0
+        while size < self.config["answer_chars"]:
+            word = rng.choice(WORDS)
+            words.append(word)
+            size += len(word) + 1
+        return " ".join(words)
+
+    def photo(self, name):
+        """JPEG, детерминированный по имени файла: одинаковые file_unique_id — одинаковые фото"""
+        if name not in self.photos:
+            try:
+                from PIL import Image
+            except ImportError:
+                self.photos[name] = random.Random(name).randbytes(120_000)
+                return self.photos[name]
+
+            rng = random.Random(name)
+            cells = Image.new("RGB", (8, 6))
+            cells.putdata([(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(48)])
+            output = io.BytesIO()
+            cells.resize((1280, 960)).save(output, format="JPEG", quality=85)
+            self.photos[name] = output.getvalue()
+        return self.photos[name]
+
+
+class TelegramHandler(tornado.web.RequestHandler):
+    """POST /bot<токен>/<метод>: ответы в формате Bot API"""
+
+    def initialize(self, state):
+        self.state = state
+
+    async def post(self, method):
+        state = self.state
+        config = state.config
+        # В пределах чата запросы идут по порядку, поэтому ключ — метод и чат (или файл)
+        rng = state.request_rng(method, self.get_body_argument("chat_id", None), self.get_body_argument("file_id", None))
+        await asyncio.sleep(state.delay(rng, config["telegram_latency"], config["telegram_sigma"]))
+
+        if method in ("sendMessage", "editMessageText") and rng.random() < config["telegram_429_rate"]:
+            self.set_status(429)
+            self.write({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                        "parameters": {"retry_after": 1}})
+            return
+
+        chat_id = self.get_body_argument("chat_id", "0")
+        if method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "editMessageText", "sendPhoto"):
+            result = {
+                "message_id": next(state.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "private"},
+                "from": BOT_USER,
+                "text": self.get_body_argument("text", ""),
+            }
+        elif method == "getFile":
+            file_id = self.get_body_argument("file_id")
+            result = {"file_id": file_id, "file_unique_id": file_id,
+                      "file_size": len(state.photo(file_id)), "file_path": f"photos/{file_id}.jpg"}
+        else:
+            result = True
+        self.write({"ok": True, "result": result})
+
+
+class TelegramFileHandler(tornado.web.RequestHandler):
+    """GET /file/bot<токен>/photos/<file_id>.jpg: содержимое фото"""
+
+    def initialize(self, state):
+        self.state = state
+
+    async def get(self, file_id):
+        state = self.state
+        rng = state.request_rng("file", file_id)
+        await asyncio.sleep(state.delay(rng, state.config["telegram_latency"], state.config["telegram_sigma"]))
+        self.set_header("Content-Type", "image/jpeg")
+        self.write(state.photo(file_id))
+
+
+class GeminiHandler(tornado.web.RequestHandler):
+    """POST /models/<модель>:<метод>: generateContent, streamGenerateContent (SSE) и countTokens"""
+
+    def initialize(self, state):
+        self.state = state
+
+    async def post(self, model, method):
+        state = self.state
+        config = state.config
+        prompt_tokens = len(self.request.body) // 4
+        rng = state.request_rng(model, method, self.request.body)
+
+        if method == "countTokens":
+            self.write({"totalTokens": prompt_tokens})
+            return
+
+        # Ссылку на неизвестный или «истекший» кэш Gemini отклоняет, и бот повторяет запрос без кэша
+        if b'"cachedContent"' in self.request.body:
+            name = json.loads(self.request.body)["cachedContent"]
+            if name not in state.cached_contents or rng.random() < config["cache_reject_rate"]:
+                state.cached_contents.discard(name)
+                self.set_status(404)
+                self.write({"error": {"code": 404, "message": f"{name} not found", "status": "NOT_FOUND"}})
+                return
+
+        latency = state.delay(rng, config["gemini_latency"], config["gemini_sigma"])
+        if rng.random() < config["gemini_error_rate"]:
+            await asyncio.sleep(latency / 2)
+            self.set_status(503)
+            self.write({"error": {"code": 503, "message": "The model is overloaded.", "status": "UNAVAILABLE"}})
+            return
+
+        text = state.answer(rng)
+        usage = {"promptTokenCount": prompt_tokens, "candidatesTokenCount": len(text) // 4,
+                 "totalTokenCount": prompt_tokens + len(text) // 4}
+
+        if method == "generateContent":
+            await asyncio.sleep(latency)
+            self.write({"candidates": [{"content": {"role": "model", "parts": [{"text": text}]},
+                                        "finishReason": "STOP"}],
+                        "usageMetadata": usage})
+            return
+
+        # Первый кусок приходит через треть задержки, остальные — равномерно за оставшееся время
+        self.set_header("Content-Type", "text/event-stream")
+        chunks = max(1, config["stream_chunks"])
+        size = math.ceil(len(text) / chunks)
+        await asyncio.sleep(latency / 3)
+        for index in range(chunks):
+            data = {"candidates": [{"content": {"role": "model", "parts": [{"text": text[index * size:(index + 1) * size]}]}}]}
+            if index == chunks - 1:
+                data["usageMetadata"] = usage
+            self.write(f"data: {json.dumps(data, ensure_ascii=False)}\r\n\r\n")
+            await self.flush()
+            if index < chunks - 1:
+                await asyncio.sleep(latency * 2 / 3 / chunks)
+
+
+class CachedContentsHandler(tornado.web.RequestHandler):
+    """POST /cachedContents: создает кэш контекста, на который потом ссылаются запросы"""
+
+    def initialize(self, state):
+        self.state = state
+
+    def post(self):
+        body = json.loads(self.request.body)
+        name = f"cachedContents/{hashlib.sha1(json.dumps(body['contents']).encode()).hexdigest()[:12]}"
+        self.state.cached_contents.add(name)
+        self.write({"name": name, "model": body["model"], "ttl": body.get("ttl")})
+
+
+async def serve_fakes(config, connection):
+    from tornado.httpserver import HTTPServer
+    from tornado.netutil import bind_sockets
+
+    state = FakeState(config)
+    telegram = tornado.web.Application([
+        (r"/bot[^/]+/(\w+)", TelegramHandler, {"state": state}),
+        (r"/file/bot[^/]+/photos/(.+)\.jpg", TelegramFileHandler, {"state": state}),
+    ])
+    gemini = tornado.web.Application([
+        (r"/models/([^/:]+):(\w+)", GeminiHandler, {"state": state}),
+        (r"/cachedContents", CachedContentsHandler, {"state": state}),
+    ])
+
+    ports = []
+    for app in (telegram, gemini):
+        sockets = bind_sockets(0, "127.0.0.1")
+        HTTPServer(app).add_sockets(sockets)
+        ports.append(sockets[0].getsockname()[1])
+    connection.send(ports)
+    await asyncio.Event().wait()
+
+
+def run_fakes(config, connection):
+    """Точка входа процесса заглушек"""
+    logging.getLogger("tornado.access").setLevel(logging.CRITICAL)
+    try:
+        asyncio.run(serve_fakes(config, connection))
+    except KeyboardInterrupt:
+        pass
+
+
+# =====================================================================
+# СИНТЕТИЧЕСКИЕ ПОЛЬЗОВАТЕЛИ
+# =====================================================================
+
+def make_update(bot_module, tg_bot, kind, user_id, update_id, rng, args):
+    """Обновление Telegram в том виде, в каком его прислал бы Bot API"""
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    chat = {"id": user_id, "type": "private", "first_name": user["first_name"]}
+    message = {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": user}
+
+    if kind == "text":
+        message["text"] = rng.choice(TEXTS)
+        data = {"update_id": update_id, "message": message}
+    elif kind == "photo":
+        file_id = f"photo-{rng.randrange(args.photo_variety)}"
+        message["photo"] = [{"file_id": file_id, "file_unique_id": file_id,
+                             "width": 1280, "height": 960, "file_size": 120_000}]
+        data = {"update_id": update_id, "message": message}
+    else:
+        data = {"update_id": update_id, "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": str(user_id),
+            "data": rng.choice(bot_module.QUICK_ACTIONS),
+            "message": dict(message, **{"from": BOT_USER, "text": "Выберите действие"}),
+        }}
+    return bot_module.Update.de_json(data, tg_bot)
+
+
+async def run_user(bot_module, application, user_id, args, latencies):
+    rng = random.Random(args.seed * 100_003 + user_id)
+    weights = [args.text_share, args.button_share, args.photo_share]
+    processor = application.update_processor
+
+    for action in range(args.actions):
+        kind = rng.choices(KINDS, weights)[0]
+        # Номер обновления от пользователя и шага, а не от порядка прихода
+        update_id = user_id * args.actions + action + 1
+        update = make_update(bot_module, application.bot, kind, user_id, update_id, rng, args)
+        # Тот же путь, что и у обновлений из Updater: через PerUserUpdateProcessor к обработчикам
+        started = time.perf_counter()
+        await processor.process_update(update, application.process_update(update))
+        latencies[kind].append(time.perf_counter() - started)
+        if args.think:
+            await asyncio.sleep(rng.expovariate(1 / args.think))
+
+
+async def drive(bot_module, args):
+    application = bot_module.build_application(with_updater=False)
+    bot_module.register_handlers(application)
+    await application.initialize()
+    await bot_module.on_startup(application)
+
+    latencies = {kind: [] for kind in KINDS}
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        run_user(bot_module, application, 10_000 + user, args, latencies) for user in range(args.users)
+    ))
+    elapsed = time.perf_counter() - started
+
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    if args.tracemalloc:
+        tracemalloc.stop()
+
+    errors = sum(value for (name, _), value in bot_module.metrics.counters.items() if name == "bot_errors_total")
+    telegram_requests = application.bot.rate_limiter.requests
+    context_cache = bot_module.assistant.context_cache.as_dict() if bot_module.GEMINI_CONTEXT_CACHE else None
+    await bot_module.on_shutdown(application)
+    await application.shutdown()
+    return latencies, elapsed, traced_peak, errors, telegram_requests, context_cache
+
+
+# =====================================================================
+# ОТЧЕТ
+# =====================================================================
+
+def percentile(ordered, q):
+    """Перцентиль по ближайшему рангу из отсортированного списка"""
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    if not ordered:
+        return {"count": 0}
+    return {
+        "count": len(ordered),
+        "p50": percentile(ordered, 0.50),
+        "p95": percentile(ordered, 0.95),
+        "p99": percentile(ordered, 0.99),
+        "max": ordered[-1],
+    }
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024  # байты на macOS, КБ на Linux
+
+
+def report(latencies, elapsed, traced_peak, errors, telegram_requests, context_cache):
+    rows = {kind: summarize(samples) for kind, samples in latencies.items()}
+    rows["всего"] = summarize([value for samples in latencies.values() for value in samples])
+    total = rows["всего"]["count"]
+
+    print(f"{'действие':>10} {'запросов':>9} {'p50, с':>8} {'p95, с':>8} {'p99, с':>8} {'макс, с':>8}")
+    for kind, row in rows.items():
+        if row["count"]:
+            print(f"{kind:>10} {row['count']:>9} {row['p50']:>8.3f} {row['p95']:>8.3f} "
+                  f"{row['p99']:>8.3f} {row['max']:>8.3f}")
+
+    rss = peak_rss_mb()
+    print(f"\nПропускная способность: {total / elapsed:.1f} обновлений/с ({total} за {elapsed:.1f} с)")
+    print(f"Пик RSS: {'н/д' if rss is None else f'{rss:.1f} МБ'}"
+          + ("" if traced_peak is None else f", пик выделений Python: {traced_peak / 1024 / 1024:.1f} МБ"))
+    print(f"Ошибок обработки: {errors}, запросов к Bot API: {telegram_requests}")
+    if context_cache is not None:
+        print(f"Кэш контекста: создано {context_cache['created']}, использован {context_cache['reused']} раз, "
+              f"отклонен {context_cache['fallbacks']} раз")
+
+    return {
+        "latency": rows,
+        "throughput": total / elapsed,
+        "elapsed": elapsed,
+        "peak_rss_mb": rss,
+        "traced_peak_mb": None if traced_peak is None else traced_peak / 1024 / 1024,
+        "errors": errors,
+        "telegram_requests": telegram_requests,
+        "context_cache": context_cache,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=50, help="одновременных пользователей")
+    parser.add_argument("--actions", type=int, default=10, help="действий на пользователя")
+    parser.add_argument("--think", type=float, default=0.0, help="средняя пауза пользователя между действиями, с")
+    parser.add_argument("--text-share", type=float, default=0.5)
+    parser.add_argument("--button-share", type=float, default=0.35)
+    parser.add_argument("--photo-share", type=float, default=0.15)
+    parser.add_argument("--photo-variety", type=int, default=20, help="различных фото на всех пользователей")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--gemini-latency", type=float, default=0.8, help="медиана задержки Gemini, с")
+    parser.add_argument("--gemini-sigma", type=float, default=0.5, help="разброс логнормальной задержки")
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--telegram-latency", type=float, default=0.03, help="медиана задержки Bot API, с")
+    parser.add_argument("--telegram-sigma", type=float, default=0.3)
+    parser.add_argument("--telegram-429-rate", type=float, default=0.0, help="доля ответов 429 на отправку")
+    parser.add_argument("--answer-chars", type=int, default=1200, help="длина ответа Gemini")
+    parser.add_argument("--stream-chunks", type=int, default=8, help="кусков в потоковом ответе")
+    parser.add_argument("--context-cache", action="store_true",
+                        help="включить кэш контекста Gemini без порога по длине промпта")
+    parser.add_argument("--cache-reject-rate", type=float, default=0.0,
+                        help="доля запросов, в которых заглушка отклоняет кэш контекста (404)")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="переменная окружения для бота, например GEMINI_STREAMING=0")
+    parser.add_argument("--tracemalloc", action="store_true", help="считать пик выделений Python (медленнее)")
+    parser.add_argument("--json", help="сохранить результаты в JSON-файл")
+    parser.add_argument("--fail-p95", type=float, help="код выхода 1, если общий p95 больше, с")
+    return parser.parse_args()
+
+
+def run_bench():
+    args = parse_args()
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    fakes = context.Process(target=run_fakes, args=(vars(args), sender), name="bench-fakes", daemon=True)
+    fakes.start()
+    telegram_port, gemini_port = receiver.recv()
+
+    os.environ.update(BENCH_ENV)
+    os.environ["TELEGRAM_API_BASE"] = f"http://127.0.0.1:{telegram_port}"
+    os.environ["GEMINI_API_BASE"] = f"http://127.0.0.1:{gemini_port}"
+    if args.context_cache:
+        # Промпт бота короче минимума cachedContents, заглушке порог не нужен
+        os.environ.update(GEMINI_CONTEXT_CACHE="1", GEMINI_CONTEXT_CACHE_MIN_TOKENS="0")
+    for item in args.set:
+        key, _, value = item.partition("=")
+        os.environ[key] = value
+
+    # Файлы бота (лог, кэши) — во временном каталоге
+    os.chdir(tempfile.mkdtemp(prefix="bench_load_"))
+    bot_module = importlib.import_module("main")
+
+    print(f"Пользователей: {args.users}, действий на пользователя: {args.actions}, seed: {args.seed}")
+    try:
+        results = report(*asyncio.run(drive(bot_module, args)))
+    finally:
+        fakes.terminate()
+
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    p95 = results["latency"]["всего"].get("p95")
+    if args.fail_p95 is not None and p95 is not None and p95 > args.fail_p95:
+        print(f"❌ p95 {p95:.3f} с превышает порог {args.fail_p95} с")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run_bench()
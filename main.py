@@ -1,20 +1,41 @@
 import os
+import atexit
+import copy
 import json
 import logging
+import logging.handlers
+import math
+import re
 import time
-import requests
-import copy
+import httpx
 import asyncio
+import contextvars
+import functools
 import sys
 import hashlib
 import random
+import sqlite3
+import argparse
+import multiprocessing
+import secrets
+import base64
+import io
+import heapq
+import importlib.util
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from collections import Counter, OrderedDict, deque
 from datetime import datetime, timedelta
+from queue import SimpleQueue
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter, TimedOut
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     filters,
     ContextTypes,
 )
@@ -32,48 +53,271 @@ if sys.platform == 'win32':
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
-print("\n" + "=" * 50)
-print("Проверка загруженных переменных:")
-print(f"TELEGRAM_TOKEN: {'установлен' if TELEGRAM_TOKEN else 'НЕ НАЙДЕН!'}")
-print(f"GEMINI_API_KEY: {'установлен' if GEMINI_API_KEY else 'НЕ НАЙДЕН!'}")
-print("=" * 50 + "\n")
 
-if not TELEGRAM_TOKEN:
-    print("❌ КРИТИЧЕСКАЯ ОШИБКА: Токен Telegram бота не найден!")
-    exit(1)
+def check_environment():
+    """Проверяет ключи при запуске бота; модуль можно импортировать и без них (бенчмарки)"""
+    print("\n" + "=" * 50)
+    print("Проверка загруженных переменных:")
+    print(f"TELEGRAM_TOKEN: {'установлен' if TELEGRAM_TOKEN else 'НЕ НАЙДЕН!'}")
+    print(f"GEMINI_API_KEY: {'установлен' if GEMINI_API_KEY else 'НЕ НАЙДЕН!'}")
+    print("=" * 50 + "\n")
+
+    if not TELEGRAM_TOKEN:
+        print("❌ КРИТИЧЕСКАЯ ОШИБКА: Токен Telegram бота не найден!")
+        return False
+
+    if not GEMINI_API_KEY:
+        print("❌ КРИТИЧЕСКАЯ ОШИБКА: Ключ Gemini API не найден!")
+        return False
 
-if not GEMINI_API_KEY:
-    print("❌ КРИТИЧЕСКАЯ ОШИБКА: Ключ Gemini API не найден!")
-    exit(1)
+    return True
 
 # =====================================================================
 # НАСТРОЙКА ЛОГИРОВАНИЯ
 # =====================================================================
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('bot.log', mode='a', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json — запись JSON в строке, text — как в консоли
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))  # 0 — без ротации по размеру
+LOG_ROTATE_DAILY = os.getenv("LOG_ROTATE_DAILY", "1") == "1"  # новый файл после полуночи
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "7"))
+TEXT_LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(request_id)s - %(message)s"
+
+log_request_id = contextvars.ContextVar("log_request_id", default="-")
+
+
+class RequestIdFilter(logging.Filter):
+    """Добавляет к записи идентификатор обрабатываемого обновления"""
+
+    def filter(self, record):
+        record.request_id = log_request_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Кладет запись в очередь; строку лога и JSON собирает поток записи, а не обработчик бота"""
+
+    def prepare(self, record):
+        # Аргументы подставляем сразу: к моменту записи объекты могут измениться
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None  # трейсбэк не передается между процессами
+        return record
+
+
+class RotatingLogFileHandler(logging.handlers.RotatingFileHandler):
+    """Ротация по размеру и, если включено, после полуночи: bot.log.1 … bot.log.N"""
+
+    def __init__(self, filename, max_bytes, backup_count, daily):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.daily = daily
+        self.rollover_at = self._next_midnight()
+
+    @staticmethod
+    def _next_midnight():
+        return (datetime.now() + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+
+    def shouldRollover(self, record):
+        if self.daily and record.created >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = self._next_midnight()
+
+
+class LazyJson:
+    """Откладывает json.dumps до момента, когда запись точно попадет в лог"""
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value, limit=200):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        return json.dumps(self.value, ensure_ascii=False)[:self.limit]
+
+
+def create_log_handlers():
+    """Консоль и файл с ротацией; файл пишет только главный процесс, рабочие присылают записи ему"""
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(TEXT_LOG_FORMAT))
+    handlers = [console]
+    if multiprocessing.parent_process() is None:
+        file_handler = RotatingLogFileHandler(LOG_FILE, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_ROTATE_DAILY)
+        file_handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_LOG_FORMAT))
+        handlers.append(file_handler)
+    return handlers
+
+
+def create_queue_handler(target_queue):
+    handler = LogQueueHandler(target_queue)
+    handler.addFilter(RequestIdFilter())
+    return handler
+
+
+# Обработчики бота только кладут запись в очередь, диск и консоль обслуживает отдельный поток
+log_handlers = create_log_handlers()
+log_queue = SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, *log_handlers)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logging.basicConfig(level=LOG_LEVEL, handlers=[create_queue_handler(log_queue)])
 
 logging.getLogger('httpx').setLevel(logging.WARNING)
 logging.getLogger('telegram').setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 
-logger.info("=" * 50)
-logger.info("Начало работы бота")
-logger.info(f"Токен Telegram: {TELEGRAM_TOKEN[:5]}...{TELEGRAM_TOKEN[-5:]}")
-logger.info(f"Ключ Gemini: {GEMINI_API_KEY[:5]}...{GEMINI_API_KEY[-5:]}")
-logger.info("=" * 50)
-
 # =====================================================================
 # КОНФИГУРАЦИЯ БОТА
 # =====================================================================
 
-# Обобщенный профиль пациента
+# Адрес и модель Gemini (адрес можно направить на локальный тестовый сервер)
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+
+# Кэширование системного промпта на стороне Gemini (cachedContents). Gemini принимает
+# только достаточно длинный контекст, поэтому короткие промпты отправляются целиком
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "0") == "1"
+GEMINI_CONTEXT_CACHE_MODEL = os.getenv("GEMINI_CONTEXT_CACHE_MODEL", "gemini-1.5-flash-001")  # нужна версия модели
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "32768"))
+
+# Настройки пула соединений с Gemini
+GEMINI_HTTP2 = os.getenv("GEMINI_HTTP2", "1") == "1"
+GEMINI_POOL_SIZE = int(os.getenv("GEMINI_POOL_SIZE", "10"))
+GEMINI_KEEPALIVE_CONNECTIONS = int(os.getenv("GEMINI_KEEPALIVE_CONNECTIONS", "5"))
+GEMINI_KEEPALIVE_EXPIRY = float(os.getenv("GEMINI_KEEPALIVE_EXPIRY", "60"))
+
+# Допуск запросов к Gemini: одновременные запросы, бюджет токенов в минуту и очередь
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_TOKENS_PER_MINUTE = int(os.getenv("GEMINI_TOKENS_PER_MINUTE", "0"))  # 0 — без ограничения
+GEMINI_MAX_QUEUE = int(os.getenv("GEMINI_MAX_QUEUE", "50"))  # ожидающих, после которых отвечаем «занято»
+GEMINI_QUEUE_TIMEOUT = float(os.getenv("GEMINI_QUEUE_TIMEOUT", "10"))  # секунд ожидания в очереди
+
+# Устойчивость запросов к Gemini: повторы, дублирующий запрос и размыкатель цепи
+GEMINI_RETRIES = int(os.getenv("GEMINI_RETRIES", "2"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "0.5"))  # секунд перед первым повтором
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "8"))
+GEMINI_HEDGE = os.getenv("GEMINI_HEDGE", "0") == "1"  # второй запрос, если первый медленнее p95
+GEMINI_MIN_TIMEOUT = float(os.getenv("GEMINI_MIN_TIMEOUT", "5"))  # нижняя граница адаптивного таймаута
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))  # сбоев подряд до размыкания
+GEMINI_BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))  # секунд до пробного запроса
+
+# Маршрутизация по моделям: быстрая модель для коротких вопросов и сводок истории
+GEMINI_FAST_MODEL = os.getenv("GEMINI_FAST_MODEL", "gemini-1.5-flash-8b")
+SHORT_QUESTION_LENGTH = int(os.getenv("SHORT_QUESTION_LENGTH", "150"))  # символов
+GEMINI_ROUTES = os.getenv("GEMINI_ROUTES", "")  # JSON с переопределениями таблицы MODEL_ROUTES
+
+# Потоковая выдача ответов
+GEMINI_STREAMING = os.getenv("GEMINI_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))  # секунд между правками сообщения
+
+# Общий кэш ответов на кнопки быстрых действий
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "256"))
+ANSWER_CACHE_BY_HISTORY = os.getenv("ANSWER_CACHE_BY_HISTORY", "0") == "1"  # учитывать историю пользователя
+ANSWER_STORE_PATH = os.getenv("ANSWER_STORE_PATH", "answers_cache.json")
+
+# Хранилище сессий: "sqlite" (переживает перезапуск) или "memory"
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "sqlite")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.db")
+MAX_CACHED_SESSIONS = int(os.getenv("MAX_CACHED_SESSIONS", "5000"))  # сессий в памяти при SQLite
+
+# Бюджет истории в токенах: сверх него старые реплики сворачиваются в краткое содержание
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2000"))
+HISTORY_TOKEN_LIMIT = int(os.getenv("HISTORY_TOKEN_LIMIT", str(HISTORY_TOKEN_BUDGET * 2)))  # жесткий предел
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "300"))
+HISTORY_COUNT_TOKENS = os.getenv("HISTORY_COUNT_TOKENS", "0") == "1"  # сверять оценку через countTokens
+
+# Обработка фото: выбирается наименьший PhotoSize, у которого длинная сторона не меньше цели
+PHOTO_TARGET_SIDE = int(os.getenv("PHOTO_TARGET_SIDE", "800"))
+PHOTO_REENCODE = os.getenv("PHOTO_REENCODE", "0") == "1"  # пережимать в JPEG (нужен Pillow)
+PHOTO_JPEG_QUALITY = int(os.getenv("PHOTO_JPEG_QUALITY", "85"))
+
+# Кэш анализов фото: по file_unique_id и перцептивному хэшу (хэш требует Pillow)
+PHOTO_CACHE_ENABLED = os.getenv("PHOTO_CACHE_ENABLED", "1") == "1"
+PHOTO_CACHE_PATH = os.getenv("PHOTO_CACHE_PATH", "photo_cache.db")
+PHOTO_CACHE_SIZE = int(os.getenv("PHOTO_CACHE_SIZE", "2000"))
+PHOTO_CACHE_TTL = timedelta(days=int(os.getenv("PHOTO_CACHE_TTL_DAYS", "30")))
+PHOTO_HASH_DISTANCE = int(os.getenv("PHOTO_HASH_DISTANCE", "4"))  # допустимое число отличающихся бит
+
+# Адрес Bot API: свой сервер telegram-bot-api или заглушка из benchmarks/bench_load.py
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+
+# Исходящие запросы к Telegram: ~30 сообщений/с на бота, ~1/с в личный чат, 20/мин в группу
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", str(20 / 60)))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))  # сообщений подряд без ожидания
+TELEGRAM_SEND_RETRIES = int(os.getenv("TELEGRAM_SEND_RETRIES", "3"))  # повторов при 429 и таймаутах
+
+# Параллельная обработка обновлений
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))  # число рабочих процессов
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))  # обновлений одновременно в процессе
+QUICK_ACTION_LATEST_WINS = os.getenv("QUICK_ACTION_LATEST_WINS", "0") == "1"  # новая кнопка отменяет прежнюю
+
+# Способ получения обновлений: "polling" или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный https-адрес, например https://bot.example.com
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# Ночная подготовка ответов на кнопки
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1") == "1"
+WARMUP_TIME = os.getenv("WARMUP_TIME", "00:05")  # ЧЧ:ММ по локальному времени
+WARMUP_CONCURRENCY = int(os.getenv("WARMUP_CONCURRENCY", "2"))
+
+# Профили пациентов: "file" (JSON {user_id: профиль}) или "sqlite"; без записи — общий PATIENT_PROFILE
+PROFILE_BACKEND = os.getenv("PROFILE_BACKEND", "file")
+PROFILE_PATH = os.getenv("PROFILE_PATH", "profiles.json")
+PROMPT_INDEX_SIZE = int(os.getenv("PROMPT_INDEX_SIZE", "1024"))  # скомпилированных промптов в памяти
+
+# Дневник питания
+DIARY_ENABLED = os.getenv("DIARY_ENABLED", "1") == "1"
+DIARY_DB_PATH = os.getenv("DIARY_DB_PATH", "diary.db")
+DIARY_WEEK_DAYS = int(os.getenv("DIARY_WEEK_DAYS", "7"))  # дней в недельной сводке
+
+# Локальная база знаний
+KNOWLEDGE_ENABLED = os.getenv("KNOWLEDGE_ENABLED", "1") == "1"
+KNOWLEDGE_PATH = os.getenv("KNOWLEDGE_PATH", "knowledge.json")  # проверенные ответы [{"question", "answer"}]
+KNOWLEDGE_THRESHOLD = float(os.getenv("KNOWLEDGE_THRESHOLD", "0.8"))  # уверенность для ответа без Gemini
+KNOWLEDGE_MIN_TERMS = int(os.getenv("KNOWLEDGE_MIN_TERMS", "2"))  # совпавших слов для ответа без Gemini
+KNOWLEDGE_SNIPPETS = os.getenv("KNOWLEDGE_SNIPPETS", "0") == "1"  # добавлять найденные справки в запрос
+KNOWLEDGE_SNIPPET_SCORE = float(os.getenv("KNOWLEDGE_SNIPPET_SCORE", "0.4"))
+
+# Метрики и трассировка
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))  # рабочие процессы слушают METRICS_PORT + номер
+OTEL_ENABLED = os.getenv("OTEL_ENABLED", "0") == "1"  # экспорт спанов в OpenTelemetry (OTLP)
+
+# Обобщенный профиль пациента (по умолчанию для пользователей без своего профиля)
 PATIENT_PROFILE = {
     "age": 69,
     "health_issues": [
@@ -141,21 +385,29 @@ DAILY_VARIATIONS = {
 }
 
 
-def get_system_prompt_with_date():
+def get_daily_plan(current_date):
+    """Завтрак, обед, ужин и активность на день; выбор зависит только от даты"""
+    # Создаем "семя" для псевдослучайности на основе даты;
+    # отдельный генератор не трогает глобальное состояние random
+    date_seed = int(current_date.strftime("%Y%m%d"))
+    rng = random.Random(date_seed)
+
+    # Выбираем варианты на день
+    breakfast = rng.choice(DAILY_VARIATIONS["breakfast_options"])
+    lunch = rng.choice(DAILY_VARIATIONS["lunch_options"])
+    dinner = rng.choice(DAILY_VARIATIONS["dinner_options"])
+    activity = rng.choice(DAILY_VARIATIONS["activity_suggestions"])
+    return breakfast, lunch, dinner, activity
+
+
+def get_system_prompt_with_date(current_date=None, profile=None):
     """Генерирует системный промпт с учетом текущей даты для вариативности"""
-    current_date = datetime.now()
+    current_date = current_date or datetime.now()
+    profile = PATIENT_PROFILE if profile is None else profile
     day_of_week = current_date.strftime("%A")
     date_str = current_date.strftime("%d.%m.%Y")
 
-    # Создаем "семя" для псевдослучайности на основе даты
-    date_seed = int(current_date.strftime("%Y%m%d"))
-    random.seed(date_seed)
-
-    # Выбираем варианты на день
-    breakfast = random.choice(DAILY_VARIATIONS["breakfast_options"])
-    lunch = random.choice(DAILY_VARIATIONS["lunch_options"])
-    dinner = random.choice(DAILY_VARIATIONS["dinner_options"])
-    activity = random.choice(DAILY_VARIATIONS["activity_suggestions"])
+    breakfast, lunch, dinner, activity = get_daily_plan(current_date)
 
     return (
             f"Ты - персональный ассистент-нутрициолог для пациента старшего возраста. "
@@ -163,16 +415,16 @@ def get_system_prompt_with_date():
             f"Основываясь на медицинском отчете, давай научно обоснованные рекомендации по питанию и образу жизни. "
 
             "Ключевые особенности здоровья пациента:\n"
-            + "\n".join([f"  • {issue}" for issue in PATIENT_PROFILE["health_issues"]]) + "\n\n"
+            + "\n".join([f"  • {issue}" for issue in profile.get("health_issues", [])]) + "\n\n"
 
                                                                                           "Диетические рекомендации:\n"
-            + "\n".join([f"  • {rec}" for rec in PATIENT_PROFILE["dietary_recommendations"]]) + "\n\n"
+            + "\n".join([f"  • {rec}" for rec in profile.get("dietary_recommendations", [])]) + "\n\n"
 
                                                                                                 "Приоритеты в питании:\n"
-            + "\n".join([f"  • {priority}" for priority in PATIENT_PROFILE["key_priorities"]]) + "\n\n"
+            + "\n".join([f"  • {priority}" for priority in profile.get("key_priorities", [])]) + "\n\n"
 
                                                                                                  "Противопоказания:\n"
-            + "\n".join([f"  • {contra}" for contra in PATIENT_PROFILE["contraindications"]]) + "\n\n"
+            + "\n".join([f"  • {contra}" for contra in profile.get("contraindications", [])]) + "\n\n"
 
                                                                                                 f"Рекомендации на сегодня ({day_of_week}):\n"
                                                                                                 f"  • Завтрак: {breakfast}\n"
@@ -193,276 +445,2946 @@ def get_system_prompt_with_date():
     )
 
 
+def get_profile_hash(profile=None):
+    """Возвращает короткий хэш профиля пациента для ключей кэша"""
+    profile = PATIENT_PROFILE if profile is None else profile
+    raw = json.dumps(profile, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:12]
+
+
+DEFAULT_PROFILE_HASH = get_profile_hash(PATIENT_PROFILE)
+PROFILE_LIST_FIELDS = ("health_issues", "dietary_recommendations", "key_priorities", "contraindications")
+
+
+def profile_error(profile):
+    """Описание ошибки в профиле или None, если по нему можно собрать системный промпт"""
+    if not isinstance(profile, dict):
+        return "профиль должен быть объектом"
+    for field in PROFILE_LIST_FIELDS:
+        value = profile.get(field, [])
+        if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+            return f"поле {field} должно быть списком строк"
+    return None
+
+
+class GeminiError(Exception):
+    """Ошибка обращения к Gemini с готовым текстом для пользователя"""
+
+    def __init__(self, user_message):
+        super().__init__(user_message)
+        self.user_message = user_message
+
+
+class GeminiBusy(GeminiError):
+    """Запрос не допущен к Gemini из-за перегрузки"""
+
+    def __init__(self):
+        super().__init__("⏳ Сейчас очень много запросов. Попробуйте еще раз через минуту.")
+
+
+class GeminiUnavailable(GeminiError):
+    """Gemini недавно сбоил подряд, запрос отклонен без обращения к нему"""
+
+    def __init__(self):
+        super().__init__("🔧 AI-сервис временно недоступен. Попробуйте через пару минут.")
+
+
+# =====================================================================
+# СТАТИСТИКА ПУЛА СОЕДИНЕНИЙ
+# =====================================================================
+
+class PoolStats:
+    """Считает запросы и новые соединения по трассировке httpcore"""
+
+    def __init__(self):
+        self.requests = 0
+        self.handshakes = 0
+        self.tls_handshakes = 0
+        self.http2_requests = 0
+
+    def trace_for_request(self):
+        """Возвращает trace-колбэк для одного запроса"""
+        self.requests += 1
+
+        async def trace(event_name, info):
+            if event_name == "connection.connect_tcp.complete":
+                self.handshakes += 1
+            elif event_name == "connection.start_tls.complete":
+                self.tls_handshakes += 1
+            elif event_name == "http2.send_request_headers.started":
+                self.http2_requests += 1
+
+        return trace
+
+    @property
+    def reused(self):
+        return max(self.requests - self.handshakes, 0)
+
+    @property
+    def reuse_ratio(self):
+        return self.reused / self.requests if self.requests else 0.0
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "handshakes": self.handshakes,
+            "tls_handshakes": self.tls_handshakes,
+            "reused": self.reused,
+            "reuse_ratio": round(self.reuse_ratio, 3),
+            "http2_requests": self.http2_requests,
+        }
+
+
+# =====================================================================
+# МЕТРИКИ И ТРАССИРОВКА
+# =====================================================================
+
+METRIC_HELP = {
+    "bot_update_seconds": ("histogram", "Время обработки обновления по обработчику и кнопке"),
+    "bot_span_seconds": ("histogram", "Время участков обработки: загрузка, сессия, запрос к Gemini, отправка"),
+    "bot_errors_total": ("counter", "Ошибки при обработке обновлений"),
+    "bot_cache_hits_total": ("counter", "Попадания в кэши"),
+    "bot_cache_misses_total": ("counter", "Промахи кэшей"),
+    "bot_component_stat": ("gauge", "Числовые показатели компонентов из as_dict()"),
+}
+
+
+class MetricsRegistry:
+    """Счетчики и гистограммы в памяти процесса, выгружаются в текстовом формате Prometheus"""
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 12, 20, 30, 60)
+
+    def __init__(self):
+        self.counters = {}  # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> [счетчики корзин..., сумма, количество]
+        self.collectors = []  # функции, возвращающие [(имя, метки, значение)] в момент выгрузки
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, labels=()):
+        key = (name, labels)
+        values = self.histograms.get(key)
+        if values is None:
+            values = self.histograms[key] = [0] * (len(self.BUCKETS) + 2)
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                values[i] += 1
+        values[-2] += seconds
+        values[-1] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        # Значения меток берутся из фиксированных наборов (обработчики, кнопки, методы API)
+        pairs = tuple(labels) + tuple(extra)
+        return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}" if pairs else ""
+
+    def render(self):
+        samples = {}  # имя -> [строки]
+        for (name, labels), value in self.counters.items():
+            samples.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+        for collect in self.collectors:
+            try:
+                for name, labels, value in collect():
+                    samples.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+            except Exception as e:
+                logger.warning(f"Не удалось собрать метрики: {str(e)}")
+        for (name, labels), values in self.histograms.items():
+            lines = samples.setdefault(name, [])
+            for bound, count in zip(self.BUCKETS, values):
+                lines.append(f"{name}_bucket{self._labels(labels, (('le', bound),))} {count}")
+            lines.append(f"{name}_bucket{self._labels(labels, (('le', '+Inf'),))} {values[-1]}")
+            lines.append(f"{name}_sum{self._labels(labels)} {values[-2]:.6f}")
+            lines.append(f"{name}_count{self._labels(labels)} {values[-1]}")
+
+        output = []
+        for name, lines in samples.items():
+            kind, help_text = METRIC_HELP.get(name, ("untyped", name))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(lines)
+        return "\n".join(output) + "\n"
+
+
+metrics = MetricsRegistry()
+
+
+def create_tracer():
+    """Трассировщик OpenTelemetry, если экспорт включен и пакет установлен"""
+    if not OTEL_ENABLED:
+        return None
+    try:
+        from opentelemetry import trace as otel_trace
+    except ImportError:
+        logger.warning("Пакет opentelemetry-api не установлен, экспорт трассировок отключен")
+        return None
+
+    try:
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError:
+        logger.info("OpenTelemetry SDK не установлен, спаны уходят в глобально настроенный провайдер")
+    else:
+        provider = TracerProvider()
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))  # адрес из OTEL_EXPORTER_OTLP_*
+        otel_trace.set_tracer_provider(provider)
+    return otel_trace.get_tracer("rightfoodbot")
+
+
+tracer = create_tracer()
+
+
+class UpdateTrace:
+    """Участки обработки одного обновления для итоговой строки в логе"""
+    __slots__ = ("handler", "action", "started", "spans")
+
+    def __init__(self, handler, action=""):
+        self.handler = handler
+        self.action = action
+        self.started = time.perf_counter()
+        self.spans = []  # [(участок, секунды)]
+
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def record_span(name, seconds):
+    """Учитывает длительность участка в гистограмме и в трассе текущего обновления"""
+    trace = current_trace.get()
+    handler = trace.handler if trace is not None else "background"
+    metrics.observe("bot_span_seconds", seconds, (("handler", handler), ("span", name)))
+    if trace is not None:
+        trace.spans.append((name, seconds))
+
+
+@contextmanager
+def span(name, **attributes):
+    """Замеряет участок обработки; при включенном OpenTelemetry открывает одноименный спан"""
+    started = time.perf_counter()
+    with tracer.start_as_current_span(name, attributes=attributes) if tracer else nullcontext():
+        try:
+            yield
+        finally:
+            record_span(name, time.perf_counter() - started)
+
+
+def record_error(kind):
+    trace = current_trace.get()
+    metrics.inc("bot_errors_total", (("handler", trace.handler if trace is not None else "background"), ("kind", kind)))
+
+
+def instrument(handler_name):
+    """Оборачивает обработчик: трасса обновления, гистограмма по обработчику и кнопке, счетчик ошибок"""
+    def decorator(callback):
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            action = ""
+            if update.callback_query is not None:
+                # Метки только из известного набора, чтобы не плодить ряды метрик
+                action = update.callback_query.data if update.callback_query.data in QUICK_ACTIONS else "other"
+
+            trace = UpdateTrace(handler_name, action)
+            token = current_trace.set(trace)
+            log_token = log_request_id.set(str(update.update_id))
+            try:
+                with span("handler", handler=handler_name, action=action):
+                    return await callback(update, context)
+            except Exception:
+                record_error("unhandled")
+                raise
+            finally:
+                current_trace.reset(token)
+                elapsed = time.perf_counter() - trace.started
+                metrics.observe("bot_update_seconds", elapsed, (("handler", handler_name), ("action", action)))
+                parts = ", ".join(f"{name} {seconds:.2f}" for name, seconds in trace.spans if name != "handler")
+                logger.info(
+                    f"Трасса {handler_name}{'/' + action if action else ''}: {elapsed:.2f} с"
+                    + (f" — {parts}" if parts else "")
+                )
+                log_request_id.reset(log_token)
+        return wrapper
+    return decorator
+
+
+async def serve_metrics(reader, writer):
+    """Минимальный HTTP-обработчик: GET /metrics отдает метрики процесса"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass  # заголовки не нужны
+
+        method, path = (request_line.decode("latin-1").split() + ["", ""])[:2]
+        if method == "GET" and path.split("?")[0] == "/metrics":
+            status, body = "200 OK", metrics.render().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def component_samples(component, source):
+    """Числовые поля as_dict() компонента как метрики bot_component_stat"""
+    for stat, value in source.as_dict().items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield "bot_component_stat", (("component", component), ("stat", stat)), value
+
+
+async def start_metrics_server(port):
+    """Запускает локальный HTTP-сервер метрик; при занятом порте бот работает без него"""
+    try:
+        server = await asyncio.start_server(serve_metrics, METRICS_HOST, port)
+    except OSError as e:
+        logger.warning(f"Сервер метрик на {METRICS_HOST}:{port} не запущен: {str(e)}")
+        return None
+    logger.info(f"Метрики доступны на http://{METRICS_HOST}:{port}/metrics")
+    return server
+
+
+# =====================================================================
+# ДОПУСК ЗАПРОСОВ К GEMINI
+# =====================================================================
+
+class GeminiAdmission:
+    """Допуск запросов к Gemini: предел одновременных запросов, бюджет токенов в минуту и приоритеты
+
+    Ожидающие запросы выстраиваются в очередь по приоритету; если впереди слишком много
+    запросов или ожидание затянулось, запрос сразу отклоняется с GeminiBusy.
+    """
+    QUICK, TEXT, PHOTO, BACKGROUND = range(4)
+
+    def __init__(self, max_concurrency=GEMINI_MAX_CONCURRENCY, tokens_per_minute=GEMINI_TOKENS_PER_MINUTE,
+                 max_queue=GEMINI_MAX_QUEUE, queue_timeout=GEMINI_QUEUE_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.tokens = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.active = 0
+        self.queue = []  # куча (приоритет, номер, future, токены)
+        self.waiting = [0] * 4  # живых ожидающих по приоритетам
+        self.sequence = 0
+        self.timer = None
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def limit_share(self, share):
+        """Оставляет процессу его долю общих лимитов"""
+        self.max_concurrency = max(1, int(self.max_concurrency * share))
+        self.tokens_per_minute = int(self.tokens_per_minute * share)
+        self.tokens = float(self.tokens_per_minute)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens_per_minute, self.tokens + (now - self.updated) * self.tokens_per_minute / 60)
+        self.updated = now
+
+    def _try_take(self, tokens):
+        if self.active >= self.max_concurrency:
+            return False
+        if self.tokens_per_minute:
+            self._refill()
+            # Запрос больше всего бюджета пропускаем при полном бюджете, иначе он не пройдет никогда
+            needed = min(tokens, self.tokens_per_minute)
+            if self.tokens < needed:
+                if self.timer is None:
+                    delay = (needed - self.tokens) * 60 / self.tokens_per_minute
+                    self.timer = asyncio.get_running_loop().call_later(delay, self._on_refill)
+                return False
+            self.tokens -= tokens
+        self.active += 1
+        return True
+
+    def _on_refill(self):
+        self.timer = None
+        self._dispatch()
+
+    def _dispatch(self):
+        """Пропускает ожидающих по приоритету, пока хватает мест и токенов"""
+        while self.queue:
+            priority, _, future, tokens = self.queue[0]
+            if future.done():  # ожидание отменено или истекло
+                heapq.heappop(self.queue)
+                continue
+            if not self._try_take(tokens):
+                return
+            heapq.heappop(self.queue)
+            self.waiting[priority] -= 1
+            future.set_result(None)
+
+    def _release(self):
+        self.active -= 1
+        self._dispatch()
+
+    def _abandon(self, future, priority):
+        future.cancel()
+        self.waiting[priority] -= 1
+        self._dispatch()
+
+    def refund(self, tokens):
+        """Возвращает в бюджет зарезервированные, но не потраченные токены"""
+        if self.tokens_per_minute and tokens > 0:
+            self._refill()
+            self.tokens = min(self.tokens_per_minute, self.tokens + tokens)
+            self._dispatch()
+
+    def try_admit(self, tokens=0):
+        """Занимает место без ожидания; False, если есть очередь или нет мест и токенов"""
+        if sum(self.waiting) or not self._try_take(tokens):
+            return False
+        self.admitted += 1
+        return True
+
+    def release(self):
+        """Освобождает место, занятое через try_admit"""
+        self._release()
+
+    @asynccontextmanager
+    async def admit(self, priority, tokens=0):
+        """Держит место под запрос к Gemini; выбрасывает GeminiBusy, если ждать бессмысленно"""
+        started = time.monotonic()
+        if sum(self.waiting) or not self._try_take(tokens):
+            # Ждать имеет смысл, только если впереди не слишком много запросов
+            if sum(self.waiting[:priority + 1]) >= self.max_queue:
+                self.rejected += 1
+                logger.warning(f"Очередь к Gemini переполнена ({sum(self.waiting)}), запрос отклонен")
+                raise GeminiBusy()
+
+            future = asyncio.get_running_loop().create_future()
+            self.sequence += 1
+            heapq.heappush(self.queue, (priority, self.sequence, future, tokens))
+            self.waiting[priority] += 1
+            self.queued += 1
+            try:
+                await asyncio.wait((future,), timeout=self.queue_timeout)
+            except asyncio.CancelledError:
+                if future.done():
+                    self._release()
+                else:
+                    self._abandon(future, priority)
+                raise
+            if not future.done():
+                self._abandon(future, priority)
+                self.timed_out += 1
+                logger.warning(f"Запрос ждал Gemini дольше {self.queue_timeout:g} с и отклонен")
+                raise GeminiBusy()
+
+        waited = time.monotonic() - started
+        self.admitted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def as_dict(self):
+        return {
+            "active": self.active,
+            "waiting": sum(self.waiting),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_wait_ms": round(1000 * self.wait_total / self.admitted) if self.admitted else 0,
+            "max_wait_ms": round(1000 * self.wait_max),
+        }
+
+
+# =====================================================================
+# МАРШРУТИЗАЦИЯ ПО МОДЕЛЯМ
+# =====================================================================
+
+# Маршрут: модель, предел длины ответа и приоритет в очереди допуска
+MODEL_ROUTES = {
+    "short": {"model": GEMINI_FAST_MODEL, "max_output_tokens": 512, "priority": GeminiAdmission.TEXT},
+    "text": {"model": GEMINI_MODEL, "max_output_tokens": 1024, "priority": GeminiAdmission.TEXT},
+    "quick": {"model": GEMINI_MODEL, "max_output_tokens": 1024, "priority": GeminiAdmission.QUICK},
+    "menu": {"model": GEMINI_MODEL, "max_output_tokens": 2048, "priority": GeminiAdmission.QUICK},
+    "photo": {"model": GEMINI_MODEL, "max_output_tokens": 1024, "priority": GeminiAdmission.PHOTO},
+    "summary": {"model": GEMINI_FAST_MODEL, "max_output_tokens": SUMMARY_MAX_TOKENS,
+                "priority": GeminiAdmission.BACKGROUND},
+}
+ROUTE_FIELDS = {"model": str, "max_output_tokens": int, "priority": int}
+
+
+def parse_route_overrides(raw):
+    """Разбирает GEMINI_ROUTES; при ошибке пишет в лог и оставляет маршруты по умолчанию"""
+    if not raw:
+        return {}
+    try:
+        overrides = json.loads(raw)
+    except ValueError as e:
+        logger.error(f"GEMINI_ROUTES не разобран, используются маршруты по умолчанию: {str(e)}")
+        return {}
+    if not isinstance(overrides, dict):
+        logger.error("GEMINI_ROUTES должен быть JSON-объектом {маршрут: настройки}, используются маршруты по умолчанию")
+        return {}
+
+    valid = {}
+    for name, override in overrides.items():
+        if not isinstance(override, dict):
+            logger.error(f"GEMINI_ROUTES: настройки маршрута {name} должны быть объектом, пропущены")
+            continue
+        errors = [
+            key for key, value in override.items()
+            if key not in ROUTE_FIELDS or type(value) is not ROUTE_FIELDS[key]
+            or (key == "priority" and not 0 <= value <= GeminiAdmission.BACKGROUND)
+        ]
+        if errors:
+            logger.error(f"GEMINI_ROUTES: у маршрута {name} неверные поля {', '.join(errors)}, пропущен")
+            continue
+        valid[name] = override
+    return valid
+
+
+for _name, _override in parse_route_overrides(GEMINI_ROUTES).items():
+    MODEL_ROUTES.setdefault(_name, dict(MODEL_ROUTES["text"])).update(_override)
+
+# Кнопки, которым нужен развернутый ответ; остальные идут по маршруту "quick"
+CALLBACK_ROUTES = {"menu_today": "menu", "shopping_list": "menu"}
+
+
+def pick_route(text="", callback_data=None, image=False):
+    """Выбирает маршрут запроса по кнопке, наличию изображения и длине вопроса"""
+    if image:
+        return "photo"
+    if callback_data is not None:
+        return CALLBACK_ROUTES.get(callback_data, "quick")
+    return "short" if len(text) <= SHORT_QUESTION_LENGTH else "text"
+
+
+# =====================================================================
+# УСТОЙЧИВОСТЬ ЗАПРОСОВ К GEMINI
+# =====================================================================
+
+class LatencyTracker:
+    """Скользящее окно длительностей запросов для перцентилей"""
+    MIN_SAMPLES = 20  # до этого перцентили считаются неизвестными
+
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def quantile(self, q):
+        if len(self.samples) < self.MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class CircuitBreaker:
+    """Размыкается после серии сбоев Gemini и по истечении паузы пропускает один пробный запрос"""
+
+    def __init__(self, threshold=GEMINI_BREAKER_THRESHOLD, cooldown=GEMINI_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+        self.trips = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self.probe_started is not None else "open"
+
+    def check(self):
+        """Выбрасывает GeminiUnavailable, пока цепь разомкнута"""
+        if self.opened_at is None:
+            return
+        now = time.monotonic()
+        # Пробный запрос, который так и не завершился, через паузу считаем потерянным
+        probing = self.probe_started is not None and now - self.probe_started < self.cooldown
+        if now - self.opened_at < self.cooldown or probing:
+            self.rejected += 1
+            raise GeminiUnavailable()
+        self.probe_started = now
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("Gemini снова отвечает, цепь замкнута")
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probe_started is not None or (self.opened_at is None and self.failures >= self.threshold):
+            self.trips += 1
+            logger.warning(f"Gemini сбоит ({self.failures} подряд), запросы отклоняются {self.cooldown:g} с")
+            self.opened_at = time.monotonic()
+            self.probe_started = None
+
+    def as_dict(self):
+        return {"state": self.state, "failures": self.failures, "trips": self.trips, "rejected": self.rejected}
+
+
+class RouteStats:
+    """Задержка и расход токенов запросов одного маршрута"""
+
+    def __init__(self):
+        self.latency = LatencyTracker()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+
+    def record_usage(self, usage):
+        self.requests += 1
+        self.prompt_tokens += usage.get("promptTokenCount", 0)
+        self.output_tokens += usage.get("candidatesTokenCount", 0)
+
+    def as_dict(self):
+        p50, p95 = self.latency.quantile(0.5), self.latency.quantile(0.95)
+        return {
+            "requests": self.requests,
+            "p50_ms": None if p50 is None else round(1000 * p50),
+            "p95_ms": None if p95 is None else round(1000 * p95),
+            "prompt_tokens": self.prompt_tokens,
+            "output_tokens": self.output_tokens,
+        }
+
+
+def backoff_delay(attempt):
+    """Экспоненциальная пауза перед повтором со случайным разбросом"""
+    delay = min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+# =====================================================================
+# КЭШ ОТВЕТОВ
+# =====================================================================
+
+def next_midnight():
+    """Возвращает момент ближайшей полуночи по локальному времени"""
+    return (datetime.now() + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class AnswerCache:
+    """LRU-кэш ответов до полуночи с объединением одновременных запросов по ключу
+
+    Файл path общий для рабочих процессов: при промахе кэш перечитывает его, если файл
+    изменился (так процессы видят ответы, прогретые рабочим процессом 0), а save дописывает
+    свои ответы к уже сохраненным, не затирая чужие.
+    """
+
+    def __init__(self, max_size=ANSWER_CACHE_SIZE, path=None):
+        self.max_size = max_size
+        self.path = path
+        self.file_mtime = None  # mtime файла при последнем чтении или записи
+        self.entries = OrderedDict()  # key -> (ответ, срок годности)
+        self.inflight = {}  # key -> задача генерации
+        self.waiters = {}  # key -> число ожидающих ответа
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        value, expires_at = entry
+        if datetime.now() >= expires_at:
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, expires_at=None):
+        self.entries[key] = (value, expires_at or next_midnight())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def get_or_create(self, key, factory):
+        """Возвращает ответ из кэша или вызывает factory один раз на все одновременные запросы"""
+        value = self.get(key)
+        if value is None and self.refresh():
+            value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        task = self.inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = self.inflight[key] = asyncio.create_task(self._create(key, factory))
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            self.coalesced += 1
+
+        # Отмена одного ожидающего не должна обрывать генерацию для остальных
+        self.waiters[key] = self.waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self.waiters[key] -= 1
+            if not self.waiters[key]:
+                del self.waiters[key]
+                if not task.done():
+                    # Ответ больше никто не ждет — останавливаем запрос к Gemini
+                    task.cancel()
+
+    async def _create(self, key, factory):
+        value = await factory()
+        self.put(key, value)
+        return value
+
+    def _forget(self, key, task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        # Помечаем исключение как полученное, даже если никто не ждал
+        if not task.cancelled():
+            task.exception()
+
+    def clear(self):
+        self.entries.clear()
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _read(self):
+        """Неистекшие записи файла: {key: (ответ, срок годности)}; поврежденные пропускаются"""
+        if not self.path or not os.path.exists(self.path):
+            return {}
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                records = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Не удалось загрузить кэш ответов: {str(e)}")
+            return {}
+        if not isinstance(records, list):
+            logger.warning("Не удалось загрузить кэш ответов: ожидался список записей")
+            return {}
+
+        now = datetime.now()
+        entries = {}
+        skipped = 0
+        for record in records:
+            try:
+                key, value, expires_at = record
+                expires_at = datetime.fromisoformat(expires_at)
+                key = tuple(key)
+            except (TypeError, ValueError):
+                skipped += 1
+                continue
+            if expires_at > now:
+                entries[key] = (value, expires_at)
+        if skipped:
+            logger.warning(f"В кэше ответов пропущено поврежденных записей: {skipped}")
+        return entries
+
+    def load(self):
+        """Загружает неистекшие ответы из файла; свои ответы в памяти не заменяются"""
+        if not self.path:
+            return 0
+
+        self.file_mtime = self._mtime()
+        for key, (value, expires_at) in self._read().items():
+            if key not in self.entries:
+                self.put(key, value, expires_at)
+        return len(self.entries)
+
+    def refresh(self):
+        """Перечитывает файл, если его изменил другой процесс; True — если перечитан"""
+        if not self.path or self._mtime() == self.file_mtime:
+            return False
+        self.load()
+        return True
+
+    def save(self):
+        """Атомарно сохраняет неистекшие ответы в файл, объединяя их с уже сохраненными"""
+        if not self.path:
+            return
+
+        now = datetime.now()
+        entries = self._read()
+        entries.update((key, entry) for key, entry in self.entries.items() if entry[1] > now)
+        records = [[list(key), value, expires_at.isoformat()] for key, (value, expires_at) in entries.items()]
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(records, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self.file_mtime = self._mtime()
+
+    def as_dict(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_ratio": round((self.hits + self.coalesced) / lookups, 3) if lookups else 0.0,
+        }
+
+
+# =====================================================================
+# КЭШ АНАЛИЗА ФОТО
+# =====================================================================
+
+def perceptual_hash(image):
+    """64-битный dHash изображения или None, если Pillow не установлен"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+
+    try:
+        with Image.open(io.BytesIO(image)) as picture:
+            picture.draft("L", (64, 64))  # для JPEG декодируем сразу в уменьшенном виде
+            pixels = list(picture.convert("L").resize((9, 8)).getdata())
+    except OSError as e:
+        logger.warning(f"Не удалось посчитать хэш фото: {str(e)}")
+        return None
+
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return bits
+
+
+class PhotoAnalysisCache:
+    """Анализы блюд в SQLite: повторное фото отвечается без загрузки и запроса к Gemini"""
+
+    def __init__(self, path, max_size=PHOTO_CACHE_SIZE, ttl=PHOTO_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS photo_analyses (
+                file_unique_id TEXT NOT NULL,
+                profile_hash TEXT NOT NULL,
+                phash TEXT,
+                answer TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                last_used TEXT NOT NULL,
+                PRIMARY KEY (file_unique_id, profile_hash)
+            );
+            CREATE INDEX IF NOT EXISTS photo_analyses_by_use ON photo_analyses (last_used);
+        """)
+
+    def get(self, file_unique_id, profile_hash):
+        """Ищет анализ по file_unique_id; фото при этом даже не нужно скачивать"""
+        row = self.conn.execute(
+            "SELECT answer, created_at FROM photo_analyses WHERE file_unique_id = ? AND profile_hash = ?",
+            (file_unique_id, profile_hash)
+        ).fetchone()
+        if row is None or datetime.now() - datetime.fromisoformat(row[1]) > self.ttl:
+            return None
+
+        self._touch(file_unique_id, profile_hash)
+        self.hits += 1
+        return row[0]
+
+    def get_similar(self, phash, profile_hash):
+        """Ищет анализ визуально того же фото по расстоянию Хэмминга между хэшами"""
+        if phash is None:
+            return None
+
+        cutoff = (datetime.now() - self.ttl).isoformat()
+        rows = self.conn.execute(
+            "SELECT file_unique_id, phash, answer FROM photo_analyses "
+            "WHERE profile_hash = ? AND phash IS NOT NULL AND created_at >= ?",
+            (profile_hash, cutoff)
+        ).fetchall()
+        for file_unique_id, stored, answer in rows:
+            if bin(phash ^ int(stored, 16)).count("1") <= PHOTO_HASH_DISTANCE:
+                self._touch(file_unique_id, profile_hash)
+                self.similar_hits += 1
+                return answer
+        return None
+
+    def put(self, file_unique_id, profile_hash, phash, answer):
+        now = datetime.now()
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute(
+                "INSERT OR REPLACE INTO photo_analyses "
+                "(file_unique_id, profile_hash, phash, answer, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (file_unique_id, profile_hash, None if phash is None else f"{phash:016x}", answer,
+                 now.isoformat(), now.isoformat())
+            )
+            self.conn.execute("DELETE FROM photo_analyses WHERE created_at < ?", ((now - self.ttl).isoformat(),))
+            self.conn.execute(
+                "DELETE FROM photo_analyses WHERE rowid IN "
+                "(SELECT rowid FROM photo_analyses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_size,)
+            )
+
+    def _touch(self, file_unique_id, profile_hash):
+        self.conn.execute(
+            "UPDATE photo_analyses SET last_used = ? WHERE file_unique_id = ? AND profile_hash = ?",
+            (datetime.now().isoformat(), file_unique_id, profile_hash)
+        )
+
+    def close(self):
+        self.conn.close()
+
+    def as_dict(self):
+        lookups = self.hits + self.similar_hits + self.misses
+        return {
+            "hits": self.hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.similar_hits) / lookups, 3) if lookups else 0.0,
+        }
+
+
+# =====================================================================
+# КЭШ КОНТЕКСТА GEMINI
+# =====================================================================
+
+class ContextCache:
+    """Ссылки на cachedContents с системным промптом дня, по одной на промпт"""
+    EXPIRY_MARGIN = timedelta(minutes=1)
+
+    def __init__(self):
+        self.entries = {}  # ключ промпта -> (имя cachedContents, срок годности)
+        self.failed_until = {}
+        self.locks = {}
+        self.created = 0
+        self.reused = 0
+        self.fallbacks = 0
+
+    @staticmethod
+    def key_for(turn):
+        return hashlib.sha1(turn.text.encode('utf-8')).hexdigest()[:16]
+
+    async def get_name(self, turn, create):
+        """Возвращает имя кэша для промпта, создавая его через create(turn); None — слать промпт целиком"""
+        key = self.key_for(turn)
+        now = datetime.now()
+
+        entry = self.entries.get(key)
+        if entry and entry[1] > now:
+            self.reused += 1
+            return entry[0]
+
+        self._prune(now)
+        if self.failed_until.get(key, now) > now:
+            return None
+
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] > datetime.now():
+                self.reused += 1
+                return entry[0]
+
+            try:
+                name, expires_at = await create(turn)
+            except (GeminiError, httpx.HTTPError, KeyError, ValueError) as e:
+                # Промпт не изменится до полуночи, поэтому до нее не пробуем снова
+                logger.warning(f"Кэш контекста Gemini недоступен, промпт отправляется целиком: {str(e)}")
+                self.failed_until[key] = next_midnight()
+                return None
+
+            # Ссылки на промпты прошлых дней больше не нужны
+            self.entries = {k: v for k, v in self.entries.items() if v[1] > datetime.now()}
+            self.entries[key] = (name, expires_at - self.EXPIRY_MARGIN)
+            self.created += 1
+            logger.info(f"Создан кэш контекста Gemini {name} до {expires_at:%H:%M}")
+            return name
+
+    def _prune(self, now):
+        """Убирает истекшие отказы и свободные блокировки, чтобы ключи прошлых дней не копились"""
+        self.failed_until = {k: v for k, v in self.failed_until.items() if v > now}
+        self.locks = {k: lock for k, lock in self.locks.items() if lock.locked()}
+
+    def invalidate(self, name):
+        """Забывает кэш, который Gemini больше не принимает"""
+        self.fallbacks += 1
+        self.entries = {k: v for k, v in self.entries.items() if v[0] != name}
+
+    def as_dict(self):
+        return {
+            "active": len(self.entries),
+            "created": self.created,
+            "reused": self.reused,
+            "fallbacks": self.fallbacks,
+        }
+
+
+# =====================================================================
+# ПРОФИЛИ ПАЦИЕНТОВ
+# =====================================================================
+
+class FileProfileStore:
+    """Профили из JSON-файла {user_id: профиль}; одинаковые профили хранятся в одном экземпляре"""
+
+    def __init__(self, path):
+        self.path = path
+        self.hashes = {}  # user_id -> хэш профиля
+        self.profiles = {DEFAULT_PROFILE_HASH: PATIENT_PROFILE}  # хэш -> профиль
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            logger.info(f"Файл профилей {path} не найден, у всех пользователей общий профиль")
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Не удалось прочитать профили из {path}: {str(e)}")
+            return
+
+        if not isinstance(data, dict):
+            logger.error(f"Профили в {path} должны быть объектом {{user_id: профиль}}, у всех пользователей общий профиль")
+            return
+
+        for key, profile in data.items():
+            error = profile_error(profile)
+            try:
+                user_id = int(key)
+            except ValueError:
+                error = "ключ должен быть числовым user_id"
+            if error is not None:
+                logger.error(f"Профиль {key!r} в {path} пропущен: {error}")
+                continue
+            self._remember(user_id, profile)
+        logger.info(f"Загружено профилей: {len(self.hashes)} пользователей, {len(self.profiles)} различных")
+
+    def _remember(self, user_id, profile):
+        profile_hash = get_profile_hash(profile)
+        self.profiles.setdefault(profile_hash, profile)
+        self.hashes[user_id] = profile_hash
+        return profile_hash
+
+    def profile_hash(self, user_id):
+        return self.hashes.get(user_id, DEFAULT_PROFILE_HASH)
+
+    def profile(self, profile_hash):
+        return self.profiles.get(profile_hash, PATIENT_PROFILE)
+
+    def put(self, user_id, profile):
+        """Назначает пользователю профиль и переписывает файл целиком"""
+        error = profile_error(profile)
+        if error is not None:
+            raise ValueError(f"Неверный профиль: {error}")
+        profile_hash = self._remember(user_id, profile)
+        data = {str(uid): self.profiles[h] for uid, h in self.hashes.items()}
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+        return profile_hash
+
+    def close(self):
+        pass
+
+
+class SQLiteProfileStore:
+    """Профили в SQLite; в памяти ничего на пользователя не держится, только индекс промптов"""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS profiles (
+                user_id INTEGER PRIMARY KEY,
+                profile_hash TEXT NOT NULL,
+                profile TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS profiles_by_hash ON profiles (profile_hash);
+        """)
+
+    def profile_hash(self, user_id):
+        row = self.conn.execute("SELECT profile_hash FROM profiles WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else DEFAULT_PROFILE_HASH
+
+    def profile(self, profile_hash):
+        if profile_hash == DEFAULT_PROFILE_HASH:
+            return PATIENT_PROFILE
+        row = self.conn.execute(
+            "SELECT profile FROM profiles WHERE profile_hash = ? LIMIT 1", (profile_hash,)
+        ).fetchone()
+        return json.loads(row[0]) if row else PATIENT_PROFILE
+
+    def put(self, user_id, profile):
+        error = profile_error(profile)
+        if error is not None:
+            raise ValueError(f"Неверный профиль: {error}")
+        profile_hash = get_profile_hash(profile)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO profiles (user_id, profile_hash, profile) VALUES (?, ?, ?)",
+            (user_id, profile_hash, json.dumps(profile, ensure_ascii=False, sort_keys=True))
+        )
+        return profile_hash
+
+    def close(self):
+        self.conn.close()
+
+
+def create_profile_store():
+    """Создает хранилище профилей согласно PROFILE_BACKEND"""
+    if PROFILE_BACKEND == "sqlite":
+        return SQLiteProfileStore(PROFILE_PATH)
+    if PROFILE_BACKEND != "file":
+        logger.warning(f"Неизвестное хранилище профилей {PROFILE_BACKEND}, используется файл")
+    return FileProfileStore(PROFILE_PATH)
+
+
+profiles = create_profile_store()
+
+
+# =====================================================================
+# ДНЕВНИК ПИТАНИЯ
+# =====================================================================
+
+DIARY_MARKER = "ДНЕВНИК:"
+DIARY_ONLY_REPLY = "Записал в дневник ✅"  # если в ответе не осталось ничего, кроме строк ДНЕВНИК:
+DIARY_FORMAT = (
+    'ДНЕВНИК: {"dish": "название", "meal": "завтрак|обед|ужин|перекус", "calories": 0, '
+    '"protein": 0, "fat": 0, "carbs": 0, "flags": ["нежелательный продукт"]} — '
+    "оценка на съеденную порцию, во flags перечисли продукты, которые мне не рекомендованы."
+)
+DIARY_TEXT_INSTRUCTION = (
+    "Если в сообщении выше я рассказываю, что съел или выпил, после ответа добавь для каждого блюда "
+    f"отдельную строку {DIARY_FORMAT} Если о съеденном речи нет, такие строки не добавляй."
+)
+DIARY_PHOTO_INSTRUCTION = f"После анализа добавь для каждого блюда на фото отдельную строку {DIARY_FORMAT}"
+DIARY_MACROS = ("calories", "protein", "fat", "carbs")
+
+
+def parse_diary_entry(raw):
+    """Разбирает JSON из строки ДНЕВНИК: в запись дневника или возвращает None"""
+    start, end = raw.find("{"), raw.rfind("}")
+    if start == -1 or end < start:
+        return None
+    try:
+        data = json.loads(raw[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not str(data.get("dish") or "").strip():
+        return None
+
+    entry = {"dish": str(data["dish"]).strip()[:200], "meal": str(data.get("meal") or "").strip()[:20] or None}
+    for key in DIARY_MACROS:
+        try:
+            entry[key] = max(0.0, float(data.get(key)))
+        except (TypeError, ValueError):
+            entry[key] = None
+
+    flags = data.get("flags")
+    entry["flags"] = sorted({
+        str(flag).strip().lower()[:50] for flag in flags if str(flag).strip()
+    }) if isinstance(flags, list) else []
+    return entry
+
+
+def extract_diary_entries(text):
+    """Отделяет служебные строки ДНЕВНИК: от ответа; возвращает (текст для пользователя, записи)
+
+    Если кроме служебных строк в ответе ничего нет, текстом становится DIARY_ONLY_REPLY:
+    пустой ответ Telegram не отправит, а пустая реплика в истории ломает следующие запросы.
+    """
+    if DIARY_MARKER not in text:
+        return text, []
+
+    kept, entries = [], []
+    for line in text.split("\n"):
+        position = line.find(DIARY_MARKER)
+        if position == -1:
+            kept.append(line)
+            continue
+        if line[:position].strip("*_` \t"):
+            kept.append(line[:position].rstrip())
+        entry = parse_diary_entry(line[position + len(DIARY_MARKER):])
+        if entry is not None:
+            entries.append(entry)
+    return "\n".join(kept).rstrip() or DIARY_ONLY_REPLY, entries
+
+
+def visible_stream_length(text):
+    """Сколько символов потокового ответа можно показать, не выдав начало строки ДНЕВНИК:"""
+    position = text.find(DIARY_MARKER)
+    end = len(text) if position == -1 else position
+    line_start = text.rfind("\n", 0, end) + 1
+    prefix = text[line_start:end].strip("*_` \t")
+    if position != -1:
+        return line_start if not prefix else position
+    # Последняя строка может оказаться началом маркера — придерживаем ее до следующего куска
+    return line_start if DIARY_MARKER.startswith(prefix) else len(text)
+
+
+class FoodDiary:
+    """Дневник питания в SQLite: записи только дописываются, сводки считаются по индексу (user_id, date)"""
+
+    def __init__(self, path):
+        self.entries_logged = 0
+        self.summaries = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meals (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                date TEXT NOT NULL,
+                clock TEXT NOT NULL,
+                meal TEXT,
+                dish TEXT NOT NULL,
+                calories REAL,
+                protein REAL,
+                fat REAL,
+                carbs REAL,
+                source TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS meals_by_user_date ON meals (user_id, date);
+            CREATE TABLE IF NOT EXISTS meal_flags (
+                meal_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                date TEXT NOT NULL,
+                flag TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS meal_flags_by_user_date ON meal_flags (user_id, date);
+        """)
+
+    def append(self, user_id, entries, source, when=None):
+        """Дописывает разобранные блюда одним приемом пищи"""
+        when = when or datetime.now()
+        date, clock = when.strftime("%Y-%m-%d"), when.strftime("%H:%M")
+        with self.conn:
+            self.conn.execute("BEGIN")
+            for entry in entries:
+                meal_id = self.conn.execute(
+                    "INSERT INTO meals (user_id, date, clock, meal, dish, calories, protein, fat, carbs, source) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (user_id, date, clock, entry["meal"], entry["dish"],
+                     *(entry[key] for key in DIARY_MACROS), source)
+                ).lastrowid
+                self.conn.executemany(
+                    "INSERT INTO meal_flags (meal_id, user_id, date, flag) VALUES (?, ?, ?, ?)",
+                    [(meal_id, user_id, date, flag) for flag in entry["flags"]]
+                )
+        self.entries_logged += len(entries)
+
+    def day(self, user_id, date):
+        """Блюда за день в порядке записи"""
+        return self.conn.execute(
+            "SELECT clock, meal, dish, calories FROM meals WHERE user_id = ? AND date = ? ORDER BY id",
+            (user_id, date)
+        ).fetchall()
+
+    def totals(self, user_id, since, until):
+        """Суммы по дням: [(дата, блюд, ккал, белки, жиры, углеводы)]"""
+        return self.conn.execute(
+            "SELECT date, COUNT(*), TOTAL(calories), TOTAL(protein), TOTAL(fat), TOTAL(carbs) FROM meals "
+            "WHERE user_id = ? AND date BETWEEN ? AND ? GROUP BY date ORDER BY date",
+            (user_id, since, until)
+        ).fetchall()
+
+    def flag_counts(self, user_id, since, until, limit=5):
+        """Самые частые нежелательные продукты за период: [(продукт, раз)]"""
+        return self.conn.execute(
+            "SELECT flag, COUNT(*) FROM meal_flags WHERE user_id = ? AND date BETWEEN ? AND ? "
+            "GROUP BY flag ORDER BY COUNT(*) DESC, flag LIMIT ?",
+            (user_id, since, until, limit)
+        ).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+    def as_dict(self):
+        return {"entries_logged": self.entries_logged, "summaries": self.summaries}
+
+
+# =====================================================================
+# ЛОКАЛЬНАЯ БАЗА ЗНАНИЙ
+# =====================================================================
+
+WEEKDAYS_RU = ("понедельник", "вторник", "среду", "четверг", "пятницу", "субботу", "воскресенье")
+KNOWLEDGE_STOPWORDS = frozenset(
+    "и в во на с со к ко по о об от до за из у же ли бы а но или не мне меня мой моя мое мои я ты вы вам вас "
+    "это как что чем где когда сколько какой какая какое какие каких каким можно нужно стоит".split()
+)
+# «Можно ли …» требует оценки по профилю, а не совпадения слов: такие вопросы решает Gemini
+PERMISSION_QUESTION = re.compile(r"\b(можно|нельзя|разрешено|разрешается|допустимо)\b")
+RUSSIAN_ENDINGS = sorted(
+    "ится ется ться тся ить ать ять еть иями ями ами ого его ому ему ыми ими ой ей ий ый ая яя ое ее ую юю "
+    "ам ям ах ях ом ем ов ев ы и а я о е у ю ь й".split(),
+    key=len, reverse=True
+)
+
+# Вопросы, ответ на которые не зависит от профиля и дня
+NUTRITION_FAQ = [
+    ("В каких продуктах много цинка? Где содержится цинк, какие продукты содержат цинк",
+     "Цинк есть в тыквенных и кунжутных семечках, кедровых орехах, говядине, печени индейки, "
+     "морепродуктах (особенно мидиях), гречке, овсянке и чечевице. Из животных продуктов и вместе "
+     "с белком он усваивается лучше. 🥜"),
+    ("В каких продуктах витамин А? Продукты с витамином А",
+     "Витамин А: морковь, тыква, шпинат, абрикосы, печень, яичные желтки. Он жирорастворимый, "
+     "поэтому овощи лучше есть с ложкой растительного масла или сметаны. 🥕"),
+    ("В каких продуктах витамин Е? Продукты с витамином Е",
+     "Витамин Е: нерафинированные растительные масла, миндаль, фундук, семечки подсолнечника, "
+     "шпинат и брокколи. Горсти орехов или семечек в день обычно достаточно. 🌻"),
+    ("Где взять аминокислоты и белок? Продукты с белком, полноценный белок",
+     "Полноценный белок с незаменимыми аминокислотами: рыба, птица, яйца, творог, нежирное мясо. "
+     "Из растительных продуктов хорошо сочетать крупы с бобовыми. Распределяйте белок на все "
+     "приемы пищи. 🐟"),
+    ("Продукты с калием и магнием, электролиты, водно-электролитный баланс",
+     "Калий и магний есть в кураге, бананах, печеном картофеле, гречке, орехах, тыквенных семечках "
+     "и зелени. Они помогают поддерживать водно-электролитный баланс. 🍌"),
+    ("Сколько воды пить в день? Что пить сегодня, какие напитки",
+     "Ориентир — 1,5–2 литра жидкости в день, если врач не ограничил объем. Лучше всего чистая вода, "
+     "травяные чаи, некрепкий зеленый чай и несладкие морсы; пейте небольшими порциями в течение дня. "
+     "Кофе, сладкие напитки и алкоголь лучше ограничить. 💧"),
+]
+
+
+def tokenize(text):
+    """Значимые слова текста в нижнем регистре с грубо отрезанными окончаниями"""
+    terms = []
+    for word in re.findall(r"[а-яa-z0-9]+", text.lower().replace("ё", "е")):
+        if word in KNOWLEDGE_STOPWORDS:
+            continue
+        for ending in RUSSIAN_ENDINGS:
+            if word.endswith(ending) and len(word) - len(ending) >= 3:
+                word = word[:-len(ending)]
+                break
+        terms.append(word)
+    return terms
+
+
+def build_knowledge_entries(profile, current_date):
+    """Вопросы и ответы по профилю пациента и плану дня в том же виде, что и в системном промпте"""
+    breakfast, lunch, dinner, activity = get_daily_plan(current_date)
+    day = WEEKDAYS_RU[current_date.weekday()]
+    recommendations = profile.get("dietary_recommendations", [])
+    contraindications = profile.get("contraindications", [])
+
+    entries = [
+        ("Что приготовить на завтрак сегодня? Завтрак", f"На завтрак в {day} предлагаю: {breakfast}. 😊"),
+        ("Что приготовить на обед сегодня? Обед", f"На обед в {day} предлагаю: {lunch}. 😊"),
+        ("Что приготовить на ужин сегодня? Ужин", f"На ужин в {day} предлагаю: {dinner}. 😊"),
+        ("Что есть сегодня? Меню на сегодня, рацион на день",
+         f"Меню на {day}:\n• Завтрак: {breakfast}\n• Обед: {lunch}\n• Ужин: {dinner}\n"
+         f"• Активность: {activity} 😊"),
+        ("Какая физическая активность подойдет сегодня? Какие упражнения подойдут, нагрузка, спорт, зарядка",
+         f"В {day} подойдет: {activity}. Избегайте резких движений и нагрузок на позвоночник. 🚶"),
+    ]
+    if recommendations:
+        entries.append((
+            "Какие продукты мне рекомендованы? Что мне есть, диета, рекомендации по питанию",
+            "Ваши рекомендации по питанию:\n" + "\n".join(f"• {rec}" for rec in recommendations)
+        ))
+    if contraindications:
+        entries.append((
+            "Что мне противопоказано? Чего нельзя, противопоказания, запреты",
+            "Вам противопоказано:\n" + "\n".join(f"• {contra}" for contra in contraindications)
+        ))
+    entries.extend((rec, f"В ваших рекомендациях: «{rec}».") for rec in recommendations)
+    return entries
+
+
+class KnowledgeIndex:
+    """Инвертированный индекс TF-IDF по вопросам базы знаний"""
+
+    def __init__(self, entries):
+        self.entries = entries  # [(вопрос, ответ)]
+        self.postings = {}  # термин -> {номер записи: частота}
+        for number, (question, _) in enumerate(entries):
+            for term, count in Counter(tokenize(question)).items():
+                self.postings.setdefault(term, {})[number] = count
+
+        size = len(entries)
+        self.idf = {term: math.log((size + 1) / (len(docs) + 1)) + 1 for term, docs in self.postings.items()}
+        self.unknown_idf = math.log(size + 1) + 1  # незнакомое слово снижает уверенность сильнее всего
+        self.norms = [0.0] * size
+        for term, docs in self.postings.items():
+            for number, count in docs.items():
+                self.norms[number] += (count * self.idf[term]) ** 2
+        self.norms = [math.sqrt(norm) or 1.0 for norm in self.norms]
+
+    def search(self, query, limit=3):
+        """Возвращает [(уверенность, совпавших слов, вопрос, ответ)] по убыванию уверенности
+
+        Уверенность — доля TF-IDF веса запроса, найденная в вопросе записи;
+        при равной доле выше записи, ближе к запросу по косинусу.
+        """
+        weights = {
+            term: count * self.idf.get(term, self.unknown_idf) for term, count in Counter(tokenize(query)).items()
+        }
+        total = sum(weight * weight for weight in weights.values())
+        if not total:
+            return []
+
+        coverage, dots, matched = {}, {}, Counter()
+        for term, weight in weights.items():
+            for number, count in self.postings.get(term, {}).items():
+                coverage[number] = coverage.get(number, 0.0) + weight * weight
+                dots[number] = dots.get(number, 0.0) + weight * count * self.idf[term]
+                matched[number] += 1
+
+        ranked = sorted(coverage, key=lambda number: (coverage[number], dots[number] / self.norms[number]),
+                        reverse=True)
+        return [(coverage[number] / total, matched[number], *self.entries[number]) for number in ranked[:limit]]
+
+
+class KnowledgeBase:
+    """Локальная база знаний перед Gemini: индекс по (дате, хэшу профиля) строится один раз
+
+    В индекс входят общий FAQ, проверенные ответы из KNOWLEDGE_PATH, а также
+    рекомендации профиля и план дня из тех же данных, что и системный промпт.
+    """
+
+    def __init__(self, profile_store, path=KNOWLEDGE_PATH, max_size=PROMPT_INDEX_SIZE):
+        self.profile_store = profile_store
+        self.max_size = max_size
+        self.entries = OrderedDict()  # (дата, хэш профиля) -> KnowledgeIndex
+        self.vetted = self._load(path)
+        self.lookups = 0
+        self.answered = 0
+        self.snippets = 0
+        self.latency = LatencyTracker()
+
+    @staticmethod
+    def _load(path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            logger.error(f"Не удалось прочитать базу знаний {path}: {str(e)}")
+            return []
+
+        if not isinstance(data, list):
+            logger.error(f"База знаний {path} должна быть списком [{{\"question\", \"answer\"}}], не загружена")
+            return []
+
+        vetted = [
+            (item["question"], item["answer"]) for item in data
+            if isinstance(item, dict) and isinstance(item.get("question"), str) and isinstance(item.get("answer"), str)
+            and item["question"].strip() and item["answer"].strip()
+        ]
+        if len(vetted) < len(data):
+            logger.warning(f"В базе знаний {path} пропущено неверных записей: {len(data) - len(vetted)}")
+        logger.info(f"Загружено проверенных ответов: {len(vetted)}")
+        return vetted
+
+    def index(self, current_date=None, profile_hash=DEFAULT_PROFILE_HASH):
+        current_date = current_date or datetime.now()
+        key = (current_date.strftime("%Y-%m-%d"), profile_hash)
+
+        index = self.entries.get(key)
+        if index is None:
+            profile = self.profile_store.profile(profile_hash)
+            index = KnowledgeIndex(NUTRITION_FAQ + self.vetted + build_knowledge_entries(profile, current_date))
+            self.entries[key] = index
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(key)
+        return index
+
+    def lookup(self, query, profile_hash=DEFAULT_PROFILE_HASH):
+        """Возвращает (ответ или None, справки для запроса к Gemini)"""
+        started = time.perf_counter()
+        self.lookups += 1
+        results = self.index(profile_hash=profile_hash).search(query)
+
+        # Одно общее слово («рыба», «ужин») — еще не ответ на вопрос
+        confident = (
+            results and results[0][0] >= KNOWLEDGE_THRESHOLD and results[0][1] >= KNOWLEDGE_MIN_TERMS
+            and not PERMISSION_QUESTION.search(query.lower())
+        )
+        answer, snippets = None, []
+        if confident:
+            answer = results[0][3]
+            self.answered += 1
+        elif KNOWLEDGE_SNIPPETS:
+            snippets = [answer for score, _, _, answer in results if score >= KNOWLEDGE_SNIPPET_SCORE]
+            self.snippets += bool(snippets)
+
+        self.latency.add(time.perf_counter() - started)
+        return answer, snippets
+
+    def as_dict(self):
+        p50, p99 = self.latency.quantile(0.5), self.latency.quantile(0.99)
+        return {
+            "lookups": self.lookups,
+            "answered": self.answered,
+            "local_ratio": round(self.answered / self.lookups, 3) if self.lookups else 0.0,
+            "with_snippets": self.snippets,
+            "p50_ms": None if p50 is None else round(p50 * 1000, 2),
+            "p99_ms": None if p99 is None else round(p99 * 1000, 2),
+        }
+
+
+# =====================================================================
+# ИСТОРИЯ ДИАЛОГА
+# =====================================================================
+
+class TokenEstimator:
+    """Локальная оценка числа токенов по длине текста с подстройкой по countTokens"""
+
+    def __init__(self, chars_per_token=3.0):
+        self.chars_per_token = chars_per_token
+
+    def estimate(self, text):
+        return int(len(text) / self.chars_per_token) + 1
+
+    def calibrate(self, chars, tokens):
+        """Сдвигает коэффициент к измеренному значению (скользящее среднее)"""
+        if chars and tokens:
+            self.chars_per_token = 0.8 * self.chars_per_token + 0.2 * (chars / tokens)
+
+
+token_estimator = TokenEstimator()
+
+
+class Turn:
+    """Реплика диалога с заранее собранным фрагментом для contents запроса"""
+    __slots__ = ("role", "text", "content", "tokens")
+
+    def __init__(self, role, text):
+        self.role = role
+        self.text = text
+        self.content = {"role": role, "parts": [{"text": text}]}
+        self.tokens = token_estimator.estimate(text)
+
+
+class SystemPromptCache:
+    """Индекс промптов по (дате, хэшу профиля): каждый промпт строится один раз на всех его пользователей
+
+    Промпты вытесняются по LRU; сессии, которые еще держат вытесненную реплику,
+    продолжают с ней работать, просто без кэша контекста Gemini.
+    """
+
+    def __init__(self, profile_store, max_size=PROMPT_INDEX_SIZE):
+        self.profile_store = profile_store
+        self.max_size = max_size
+        self.entries = OrderedDict()  # (дата, хэш профиля) -> реплика
+        self.by_content = {}  # id(реплика.content) -> реплика, для find за O(1)
+        self.builds = 0
+
+    def get(self, current_date=None, profile_hash=DEFAULT_PROFILE_HASH):
+        current_date = current_date or datetime.now()
+        key = (current_date.strftime("%Y-%m-%d"), profile_hash)
+
+        turn = self.entries.get(key)
+        if turn is None:
+            profile = self.profile_store.profile(profile_hash)
+            turn = Turn("user", sys.intern(get_system_prompt_with_date(current_date, profile)))
+            self.entries[key] = turn
+            self.by_content[id(turn.content)] = turn
+            self.builds += 1
+            while len(self.entries) > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                del self.by_content[id(evicted.content)]
+        else:
+            self.entries.move_to_end(key)
+        return turn
+
+    def find(self, content):
+        """Возвращает реплику системного промпта, если content — ее фрагмент"""
+        return self.by_content.get(id(content))
+
+
+system_prompts = SystemPromptCache(profiles)
+
+
+class ConversationHistory:
+    """Кольцевой буфер последних реплик со ссылкой на общий системный промпт и кратким содержанием"""
+    __slots__ = ("system", "summary", "turns", "tokens", "maxlen")
+
+    def __init__(self, system, turns=(), maxlen=10, summary=None):
+        self.system = system
+        self.summary = summary
+        self.turns = deque()
+        self.tokens = 0  # оценка токенов в репликах (без системного промпта)
+        self.maxlen = maxlen
+        for turn in turns:
+            self.append(turn)
+
+    def append(self, turn):
+        if len(self.turns) >= self.maxlen:
+            self.popleft()
+        self.turns.append(turn)
+        self.tokens += turn.tokens
+
+    def popleft(self):
+        turn = self.turns.popleft()
+        self.tokens -= turn.tokens
+        return turn
+
+    def fold(self, folded, summary):
+        """Заменяет свернутые старые реплики кратким содержанием"""
+        for turn in folded:
+            if not self.turns or self.turns[0] is not turn:
+                break
+            self.popleft()
+        self.summary = summary
+
+    def contents(self, *extra):
+        """Собирает contents из ссылок на готовые фрагменты, не копируя их"""
+        contents = [self.system.content]
+        if self.summary is not None:
+            contents.append(self.summary.content)
+        contents.extend(turn.content for turn in self.turns)
+        contents.extend(extra)
+        return contents
+
+    def fingerprint(self):
+        """Короткий хэш реплик без системного промпта"""
+        digest = hashlib.sha1()
+        if self.summary is not None:
+            digest.update(self.summary.text.encode('utf-8'))
+        for turn in self.turns:
+            digest.update(turn.role.encode('utf-8'))
+            digest.update(turn.text.encode('utf-8'))
+        return digest.hexdigest()[:12]
+
+    def __len__(self):
+        return len(self.turns) + 1  # +1 для системного промпта
+
+
+class Session:
+    """Сессия пользователя: история диалога, хэш профиля и отметки времени"""
+    __slots__ = ("history", "last_interaction", "date_created", "profile_hash")
+
+    def __init__(self, history, last_interaction, date_created, profile_hash=DEFAULT_PROFILE_HASH):
+        self.history = history
+        self.last_interaction = last_interaction
+        self.date_created = date_created
+        self.profile_hash = profile_hash
+
+
+# =====================================================================
+# ХРАНИЛИЩЕ СЕССИЙ
+# =====================================================================
+
+class MemorySessionStore:
+    """Сессии живут только в памяти процесса и теряются при перезапуске"""
+    persistent = False
+
+    def load(self, user_id, limit):
+        return None
+
+    def update_summary(self, user_id, summary, keep):
+        pass
+
+    def create(self, user_id, date_created, last_interaction):
+        pass
+
+    def append_turns(self, user_id, turns, last_interaction, keep):
+        pass
+
+    def update_date(self, user_id, date_created):
+        pass
+
+    def delete(self, user_id):
+        pass
+
+    def purge_inactive(self, cutoff):
+        return 0
+
+    def close(self):
+        pass
+
+
+class SQLiteSessionStore:
+    """Сессии в SQLite (WAL): каждая реплика дописывается отдельно, загрузка по требованию"""
+    persistent = True
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                user_id INTEGER PRIMARY KEY,
+                date_created TEXT NOT NULL,
+                last_interaction TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS turns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                text TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS turns_by_user ON turns (user_id, id);
+        """)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(sessions)")}
+        if "summary" not in columns:
+            self.conn.execute("ALTER TABLE sessions ADD COLUMN summary TEXT")
+
+    def load(self, user_id, limit):
+        """Возвращает (date_created, last_interaction, summary, последние реплики) или None"""
+        row = self.conn.execute(
+            "SELECT date_created, last_interaction, summary FROM sessions WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        turns = self.conn.execute(
+            "SELECT role, text FROM turns WHERE user_id = ? ORDER BY id DESC LIMIT ?", (user_id, limit)
+        ).fetchall()
+        turns.reverse()
+        return row[0], datetime.fromisoformat(row[1]), row[2], turns
+
+    def create(self, user_id, date_created, last_interaction):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO sessions (user_id, date_created, last_interaction) VALUES (?, ?, ?)",
+            (user_id, date_created, last_interaction.isoformat())
+        )
+
+    def append_turns(self, user_id, turns, last_interaction, keep):
+        """Дописывает реплики одной транзакцией и удаляет вышедшие за окно истории"""
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT INTO turns (user_id, role, text) VALUES (?, ?, ?)",
+                [(user_id, role, text) for role, text in turns]
+            )
+            self.conn.execute(
+                "UPDATE sessions SET last_interaction = ? WHERE user_id = ?",
+                (last_interaction.isoformat(), user_id)
+            )
+            self.conn.execute(
+                "DELETE FROM turns WHERE user_id = ? AND id <= "
+                "(SELECT id FROM turns WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (user_id, user_id, keep)
+            )
+
+    def update_date(self, user_id, date_created):
+        self.conn.execute("UPDATE sessions SET date_created = ? WHERE user_id = ?", (date_created, user_id))
+
+    def update_summary(self, user_id, summary, keep):
+        """Сохраняет краткое содержание и удаляет свернутые в него реплики, оставляя keep последних"""
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute("UPDATE sessions SET summary = ? WHERE user_id = ?", (summary, user_id))
+            self.conn.execute(
+                "DELETE FROM turns WHERE user_id = ? AND id <= "
+                "(SELECT id FROM turns WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (user_id, user_id, keep)
+            )
+
+    def delete(self, user_id):
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute("DELETE FROM turns WHERE user_id = ?", (user_id,))
+            self.conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    def purge_inactive(self, cutoff):
+        """Удаляет сессии без активности с момента cutoff; возвращает их число"""
+        with self.conn:
+            self.conn.execute("BEGIN")
+            cutoff = cutoff.isoformat()
+            self.conn.execute(
+                "DELETE FROM turns WHERE user_id IN "
+                "(SELECT user_id FROM sessions WHERE last_interaction < ?)", (cutoff,)
+            )
+            return self.conn.execute("DELETE FROM sessions WHERE last_interaction < ?", (cutoff,)).rowcount
+
+    def close(self):
+        self.conn.close()
+
+
+def create_session_store():
+    """Создает хранилище сессий согласно SESSION_BACKEND"""
+    if SESSION_BACKEND == "sqlite":
+        return SQLiteSessionStore(SESSION_DB_PATH)
+    if SESSION_BACKEND != "memory":
+        logger.warning(f"Неизвестное хранилище сессий {SESSION_BACKEND}, используется память")
+    return MemorySessionStore()
+
+
 # =====================================================================
 # КЛАСС NUTRITION ASSISTANT
 # =====================================================================
 
 class NutritionAssistant:
-    API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent"
+    MODEL_URL = GEMINI_API_BASE + "/models/{model}:{method}"
+    CACHED_CONTENTS_URL = f"{GEMINI_API_BASE}/cachedContents"
+    CONTEXT_CACHE_REJECT_STATUSES = (400, 403, 404)  # кэш истек или не найден
+    RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+    IMAGE_PLACEHOLDER = "@@IMAGE_BASE64@@"
+    IMAGE_CHUNK_SIZE = 3 * 64 * 1024  # кратно 3, чтобы куски base64 склеивались без паддинга
+    IMAGE_TOKENS = 258  # во столько токенов Gemini оценивает одно изображение
     MAX_INPUT_LENGTH = 2000  # Увеличено с 500
-    MAX_HISTORY_LENGTH = 10  # Максимум сообщений в истории
+    MAX_HISTORY_LENGTH = 40  # Предел числа реплик; основное ограничение — бюджет токенов
+    SUMMARY_PREFIX = "Краткое содержание предыдущего разговора:\n"
     SESSION_TIMEOUT = timedelta(hours=4)  # Увеличено с 2 часов
+    REQUEST_TIMEOUT = 30  # Таймаут запроса к Gemini в секундах
+    USER_ROUTES = ("short", "text")  # маршруты вопросов, набранных пользователем (не кнопок)
 
-    def __init__(self):
-        self.user_sessions = {}
+    def __init__(self, session_store=None):
+        self.user_sessions = OrderedDict()
+        self.session_store = session_store or MemorySessionStore()
         self.last_cleanup = datetime.now()
+        self.http_client = None
+        self.pool_stats = PoolStats()
+        self.admission = GeminiAdmission()
+        self.breaker = CircuitBreaker()
+        self.routes = {name: RouteStats() for name in MODEL_ROUTES}
+        self.retries = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.hedge_skipped = 0
+        self.summary_tasks = {}
+        self.context_cache = ContextCache()
+        self.answer_cache = AnswerCache(path=ANSWER_STORE_PATH)
+        self.photo_cache = PhotoAnalysisCache(PHOTO_CACHE_PATH) if PHOTO_CACHE_ENABLED else None
+        self.diary = FoodDiary(DIARY_DB_PATH) if DIARY_ENABLED else None
+        self.knowledge = KnowledgeBase(profiles) if KNOWLEDGE_ENABLED else None
+
+    def _create_http_client(self):
+        """Создает долгоживущий клиент с keep-alive пулом и, если доступно, HTTP/2"""
+        http2 = GEMINI_HTTP2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("Пакет h2 не установлен, соединения с Gemini будут по HTTP/1.1")
+                http2 = False
+
+        return httpx.AsyncClient(
+            headers={
+                'Content-Type': 'application/json',
+                'X-goog-api-key': GEMINI_API_KEY
+            },
+            timeout=self.REQUEST_TIMEOUT,
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=GEMINI_POOL_SIZE,
+                max_keepalive_connections=GEMINI_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=GEMINI_KEEPALIVE_EXPIRY
+            )
+        )
+
+    def _get_http_client(self):
+        """Возвращает общий HTTP-клиент, создавая его при первом обращении"""
+        if self.http_client is None or self.http_client.is_closed:
+            self.http_client = self._create_http_client()
+        return self.http_client
+
+    async def start(self):
+        """Открывает пул соединений и загружает сохраненные ответы при запуске бота"""
+        self._get_http_client()
+        loaded = self.answer_cache.load()
+        if loaded:
+            logger.info(f"Загружено сохраненных ответов на кнопки: {loaded}")
+        if (self.photo_cache is not None or PHOTO_REENCODE) and importlib.util.find_spec("PIL") is None:
+            logger.warning("Pillow не установлен: поиск похожих фото и пережатие в JPEG отключены")
+        logger.info(
+            f"Пул Gemini открыт (HTTP/2: {GEMINI_HTTP2}, размер: {GEMINI_POOL_SIZE}, "
+            f"keep-alive: {GEMINI_KEEPALIVE_CONNECTIONS} на {GEMINI_KEEPALIVE_EXPIRY} с)"
+        )
+
+    async def close(self):
+        """Закрывает HTTP-клиент при остановке бота"""
+        if self.http_client is not None:
+            await self.http_client.aclose()
+            self.http_client = None
+            logger.info(f"Статистика пула Gemini: {self.pool_stats.as_dict()}")
+            logger.info(f"Статистика допуска к Gemini: {self.admission.as_dict()}")
+            logger.info(f"Маршруты Gemini: { {name: stats.as_dict() for name, stats in self.routes.items()} }")
+            logger.info(
+                f"Устойчивость Gemini: {self.breaker.as_dict()}, повторов {self.retries}, "
+                f"дублирующих запросов {self.hedged} (выиграли {self.hedge_wins}, "
+                f"пропущено без места {self.hedge_skipped})"
+            )
+
+        try:
+            self.answer_cache.save()
+        except OSError as e:
+            logger.error(f"Не удалось сохранить кэш ответов: {str(e)}")
+
+        self.session_store.close()
+        profiles.close()
+        if self.photo_cache is not None:
+            logger.info(f"Статистика кэша фото: {self.photo_cache.as_dict()}")
+            self.photo_cache.close()
+        if self.knowledge is not None:
+            logger.info(f"Статистика локальной базы знаний: {self.knowledge.as_dict()}")
+        if self.diary is not None:
+            logger.info(f"Статистика дневника питания: {self.diary.as_dict()}")
+            self.diary.close()
+
+    async def _create_cached_content(self, turn):
+        """Создает cachedContents с системным промптом, живущий до конца дня"""
+        expires_at = next_midnight() + timedelta(minutes=5)
+        ttl = int((expires_at - datetime.now()).total_seconds())
+        response = await self._get_http_client().post(
+            self.CACHED_CONTENTS_URL,
+            json={
+                "model": f"models/{GEMINI_CONTEXT_CACHE_MODEL}",
+                "contents": [turn.content],
+                "ttl": f"{ttl}s"
+            },
+            extensions={"trace": self.pool_stats.trace_for_request()}
+        )
+        if response.status_code != 200:
+            raise GeminiError(f"HTTP {response.status_code}: {response.text[:200]}")
+        return response.json()["name"], expires_at
+
+    async def _gemini_attempts(self, request_body, route, stream=False):
+        """Варианты отправки: со ссылкой на кэш контекста и запасной с промптом целиком"""
+        method = "streamGenerateContent?alt=sse" if stream else "generateContent"
+        model = MODEL_ROUTES[route]["model"]
+        attempts = [(self.MODEL_URL.format(model=model, method=method), request_body, None)]
+
+        # Кэш контекста создается для версии основной модели, другим моделям он не подходит
+        contents = request_body["contents"]
+        use_cache = GEMINI_CONTEXT_CACHE and model == GEMINI_MODEL and contents
+        system = system_prompts.find(contents[0]) if use_cache else None
+        if system is None or token_estimator.estimate(system.text) < GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+            return attempts
+
+        name = await self.context_cache.get_name(system, self._create_cached_content)
+        if name is None:
+            return attempts
+
+        cached_body = dict(request_body, contents=contents[1:], cachedContent=name)
+        cached_url = self.MODEL_URL.format(model=GEMINI_CONTEXT_CACHE_MODEL, method=method)
+        return [(cached_url, cached_body, name)] + attempts
+
+    def _reject_context_cache(self, name, response):
+        logger.warning(f"Gemini отклонил кэш контекста {name} ({response.status_code}), повтор без кэша")
+        self.context_cache.invalidate(name)
+
+    def _image_body(self, request_body, image):
+        """Готовит тело запроса, в которое base64 изображения дописывается кусками без полной копии"""
+        prefix, suffix = json.dumps(request_body, ensure_ascii=False).split(self.IMAGE_PLACEHOLDER, 1)
+        prefix, suffix = prefix.encode('utf-8'), suffix.encode('utf-8')
+        length = len(prefix) + 4 * ((len(image) + 2) // 3) + len(suffix)
+
+        async def chunks():
+            yield prefix
+            view = memoryview(image)
+            for start in range(0, len(view), self.IMAGE_CHUNK_SIZE):
+                yield base64.b64encode(view[start:start + self.IMAGE_CHUNK_SIZE])
+            yield suffix
+
+        return length, chunks()
+
+    def _timeout(self, route):
+        """Таймаут попытки по наблюдаемой задержке: вдвое больше p99, но не дольше REQUEST_TIMEOUT"""
+        p99 = self.routes[route].latency.quantile(0.99)
+        if p99 is None:
+            return self.REQUEST_TIMEOUT
+        return min(self.REQUEST_TIMEOUT, max(GEMINI_MIN_TIMEOUT, 2 * p99))
+
+    def _record_status(self, status_code):
+        if status_code in self.RETRYABLE_STATUSES:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    async def _post_gemini(self, request_body, route, image=None, reserved=0):
+        """Отправляет запрос к Gemini с повторами, дублирующим запросом и размыкателем цепи
+
+        Место в очереди допуска занимает каждая попытка, а не пауза перед повтором;
+        токены резервируются один раз, на первой попытке. Дублирующий запрос
+        занимает собственное место и собственный резерв токенов.
+        """
+        self.breaker.check()
+        priority = MODEL_ROUTES[route]["priority"]
+        latency = self.routes[route].latency
+        hedge_delay = latency.quantile(0.95) if GEMINI_HEDGE and image is None else None
+
+        for attempt in range(GEMINI_RETRIES + 1):
+            timeout = self._timeout(route)
+            try:
+                async with self.admission.admit(priority, reserved if attempt == 0 else 0):
+                    with span("gemini_http", route=route):
+                        if hedge_delay is not None and self.breaker.state == "closed":
+                            response = await self._post_hedged(request_body, route, timeout, hedge_delay, reserved)
+                        else:
+                            response = await self._post_once(request_body, route, image, timeout)
+            except (httpx.TimeoutException, httpx.TransportError) as e:
+                self.breaker.record_failure()
+                if isinstance(e, httpx.TimeoutException):
+                    # Иначе окно запомнит только быстрые ответы и таймаут будет сжиматься
+                    latency.add(timeout)
+                if attempt == GEMINI_RETRIES:
+                    raise
+                logger.warning(f"Сбой запроса к Gemini ({type(e).__name__}), повтор {attempt + 1}/{GEMINI_RETRIES}")
+            else:
+                self._record_status(response.status_code)
+                if response.status_code not in self.RETRYABLE_STATUSES or attempt == GEMINI_RETRIES:
+                    return response
+                logger.warning(f"Gemini ответил {response.status_code}, повтор {attempt + 1}/{GEMINI_RETRIES}")
+
+            self.retries += 1
+            await asyncio.sleep(backoff_delay(attempt))
+            self.breaker.check()
+
+    async def _post_hedged(self, request_body, route, timeout, delay, reserved=0):
+        """Если ответа нет дольше p95, шлет такой же запрос и берет первый успешный
+
+        Дублирующий запрос проходит допуск сам и не ждет в очереди: если свободного
+        места или токенов нет, ждем только первый запрос. Резерв проигравшего
+        запроса не возвращается — его токены считаем потраченными.
+        """
+        first = asyncio.create_task(self._post_once(request_body, route, None, timeout))
+        done, _ = await asyncio.wait((first,), timeout=delay)
+        if done:
+            return first.result()
+        if not self.admission.try_admit(reserved):
+            self.hedge_skipped += 1
+            return await first
+
+        self.hedged += 1
+        second = asyncio.create_task(self._post_once(request_body, route, None, timeout))
+        second.add_done_callback(lambda _: self.admission.release())
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                finished = [task for task in done if task.exception() is None]
+                winner = next((task for task in finished if task.result().status_code == 200), None)
+                if winner is not None:
+                    self.hedge_wins += winner is second
+                    return winner.result()
+            # Оба запроса неудачны: отдаем результат последнего
+            return done.pop().result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _post_once(self, request_body, route, image, timeout):
+        """Одна попытка generateContent через общий пул соединений"""
+        started = time.monotonic()
+        for url, body, cache_name in await self._gemini_attempts(request_body, route):
+            if image is None:
+                payload = {"json": body}
+            else:
+                length, content = self._image_body(body, image)
+                payload = {"content": content, "headers": {"Content-Length": str(length)}}
+
+            response = await self._get_http_client().post(
+                url,
+                timeout=timeout,
+                extensions={"trace": self.pool_stats.trace_for_request()},
+                **payload
+            )
+            if cache_name and response.status_code in self.CONTEXT_CACHE_REJECT_STATUSES:
+                self._reject_context_cache(cache_name, response)
+                continue
+            if response.status_code == 200:
+                self.routes[route].latency.add(time.monotonic() - started)
+            return response
+
+    @asynccontextmanager
+    async def _stream_gemini(self, request_body, route, reserved=0):
+        """Открывает потоковый ответ Gemini; повторяет попытку, только пока текст еще не пошел
+
+        Место в очереди допуска держится до конца потока, но на паузу перед повтором освобождается.
+        """
+        self.breaker.check()
+        priority = MODEL_ROUTES[route]["priority"]
+        for attempt in range(GEMINI_RETRIES + 1):
+            streaming = False
+            try:
+                async with self.admission.admit(priority, reserved if attempt == 0 else 0), \
+                        self._open_stream(request_body, route) as response:
+                    if response.status_code in self.RETRYABLE_STATUSES and attempt < GEMINI_RETRIES:
+                        await response.aread()
+                        self.breaker.record_failure()
+                        logger.warning(f"Gemini ответил {response.status_code}, повтор {attempt + 1}/{GEMINI_RETRIES}")
+                    else:
+                        self._record_status(response.status_code)
+                        streaming = True
+                        yield response
+                        return
+            except (httpx.TimeoutException, httpx.TransportError) as e:
+                if streaming:
+                    raise
+                self.breaker.record_failure()
+                if attempt == GEMINI_RETRIES:
+                    raise
+                logger.warning(f"Сбой запроса к Gemini ({type(e).__name__}), повтор {attempt + 1}/{GEMINI_RETRIES}")
+
+            self.retries += 1
+            await asyncio.sleep(backoff_delay(attempt))
+            self.breaker.check()
+
+    @asynccontextmanager
+    async def _open_stream(self, request_body, route):
+        """Открывает streamGenerateContent с тем же запасным вариантом без кэша контекста"""
+        for url, body, cache_name in await self._gemini_attempts(request_body, route, stream=True):
+            async with self._get_http_client().stream(
+                    "POST",
+                    url,
+                    json=body,
+                    extensions={"trace": self.pool_stats.trace_for_request()}
+            ) as response:
+                if cache_name and response.status_code in self.CONTEXT_CACHE_REJECT_STATUSES:
+                    await response.aread()
+                    self._reject_context_cache(cache_name, response)
+                    continue
+                yield response
+                return
 
     def _get_user_session(self, user_id):
         if datetime.now() - self.last_cleanup > timedelta(minutes=30):
             self.cleanup_sessions()
             self.last_cleanup = datetime.now()
 
+        if user_id not in self.user_sessions:
+            with span("session_load"):
+                self._load_session(user_id)
+
         if user_id not in self.user_sessions:
             # Обновляем системный промпт каждый день
             current_date = datetime.now().strftime("%Y-%m-%d")
-            self.user_sessions[user_id] = {
-                "history": [{
-                    "role": "user",
-                    "parts": [{"text": get_system_prompt_with_date()}]
-                }],
-                "last_interaction": datetime.now(),
-                "date_created": current_date
-            }
+            profile_hash = profiles.profile_hash(user_id)
+            self.user_sessions[user_id] = Session(
+                self._new_history(profile_hash=profile_hash),
+                datetime.now(),
+                current_date,
+                profile_hash
+            )
+            self.session_store.create(user_id, current_date, self.user_sessions[user_id].last_interaction)
+            self._evict_cached_sessions()
         else:
             # Проверяем, нужно ли обновить системный промпт на новый день
-            session_date = self.user_sessions[user_id].get("date_created", "")
+            session = self.user_sessions[user_id]
             current_date = datetime.now().strftime("%Y-%m-%d")
 
-            if session_date != current_date:
-                # Обновляем системный промпт на новый день
-                self.user_sessions[user_id]["history"][0] = {
-                    "role": "user",
-                    "parts": [{"text": get_system_prompt_with_date()}]
-                }
-                self.user_sessions[user_id]["date_created"] = current_date
+            if session.date_created != current_date:
+                # Обновляем системный промпт на новый день (заодно подхватываем изменившийся профиль)
+                session.profile_hash = profiles.profile_hash(user_id)
+                session.history.system = system_prompts.get(profile_hash=session.profile_hash)
+                session.date_created = current_date
+                self.session_store.update_date(user_id, current_date)
                 logger.info(f"Обновлен системный промпт для пользователя {user_id} на {current_date}")
 
+        self.user_sessions.move_to_end(user_id)
         return self.user_sessions[user_id]
 
-    def _trim_history(self, history):
-        """Обрезает историю, оставляя системный промпт и последние сообщения"""
-        if len(history) <= self.MAX_HISTORY_LENGTH + 1:  # +1 для системного промпта
-            return history
+    def _load_session(self, user_id):
+        """Лениво поднимает сессию пользователя из хранилища при первом обращении"""
+        stored = self.session_store.load(user_id, self.MAX_HISTORY_LENGTH)
+        if stored is None:
+            return None
+
+        date_created, last_interaction, summary, turns = stored
+        if datetime.now() - last_interaction > self.SESSION_TIMEOUT:
+            self.session_store.delete(user_id)
+            return None
+
+        profile_hash = profiles.profile_hash(user_id)
+        history = self._new_history((Turn(role, text) for role, text in turns), profile_hash)
+        if summary:
+            history.summary = Turn("user", summary)
+        self._trim_to_token_limit(history)
+
+        self.user_sessions[user_id] = Session(history, last_interaction, date_created, profile_hash)
+        self._evict_cached_sessions()
+        return self.user_sessions[user_id]
 
-        # Оставляем системный промпт и последние MAX_HISTORY_LENGTH сообщений
-        return [history[0]] + history[-(self.MAX_HISTORY_LENGTH):]
+    def _evict_cached_sessions(self):
+        """Ограничивает число сессий в памяти, если они сохранены на диске"""
+        if not self.session_store.persistent:
+            return
+        while len(self.user_sessions) > MAX_CACHED_SESSIONS:
+            self.user_sessions.popitem(last=False)
+
+    def find_session(self, user_id):
+        """Возвращает сессию пользователя из памяти или хранилища, не создавая новую"""
+        return self.user_sessions.get(user_id) or self._load_session(user_id)
+
+    def reset_session(self, user_id):
+        """Удаляет сессию пользователя; возвращает True, если она была"""
+        existed = self.find_session(user_id) is not None
+        self._cancel_summary(user_id)
+        self.user_sessions.pop(user_id, None)
+        self.session_store.delete(user_id)
+        return existed
+
+    def _new_history(self, turns=(), profile_hash=DEFAULT_PROFILE_HASH):
+        """Создает историю с системным промптом дня для профиля и не более MAX_HISTORY_LENGTH реплик"""
+        return ConversationHistory(
+            system_prompts.get(profile_hash=profile_hash),
+            turns,
+            maxlen=self.MAX_HISTORY_LENGTH
+        )
 
     def cleanup_sessions(self):
         now = datetime.now()
         inactive_users = []
 
         for user_id, session in self.user_sessions.items():
-            if now - session["last_interaction"] > self.SESSION_TIMEOUT:
+            if now - session.last_interaction > self.SESSION_TIMEOUT:
                 inactive_users.append(user_id)
 
         for user_id in inactive_users:
+            self._cancel_summary(user_id)
             del self.user_sessions[user_id]
+            self.session_store.delete(user_id)
             logger.info(f"Очищена сессия пользователя {user_id}")
 
-    async def process_image(self, user_id, file_path):
-        """Обрабатывает изображение еды"""
-        try:
-            import base64
+        purged = self.session_store.purge_inactive(now - self.SESSION_TIMEOUT)
+        if purged:
+            logger.info(f"Удалено неактивных сессий из хранилища: {purged}")
+
+    def lookup_photo(self, user_id, file_unique_id):
+        """Возвращает сохраненный анализ фото по file_unique_id, не скачивая его"""
+        if self.photo_cache is None:
+            return None
+
+        profile_hash = self._get_user_session(user_id).profile_hash
+        assistant_response = self.photo_cache.get(file_unique_id, profile_hash)
+        if assistant_response is None:
+            return None
+        logger.info(f"Анализ фото {file_unique_id} взят из кэша")
+        return self._remember_photo_answer(user_id, assistant_response, log_meals=False)
+
+    def _remember_photo_answer(self, user_id, assistant_response, log_meals=True):
+        """Возвращает анализ без служебных строк; блюда пишет в дневник только для свежего ответа
+
+        Из кэша приходит повторно отправленное фото: то же блюдо второй раз в дневник не попадает.
+        """
+        if log_meals:
+            assistant_response = self._log_meals(user_id, assistant_response, "photo")
+        else:
+            assistant_response, _ = extract_diary_entries(assistant_response)
+        session = self._get_user_session(user_id)
+        self._remember_turn(
+            user_id, session, Turn("user", "Пользователь отправил фото еды для анализа"), assistant_response
+        )
+        return assistant_response
 
-            with open(file_path, "rb") as image_file:
-                image_data = base64.b64encode(image_file.read()).decode('utf-8')
+    def _log_meals(self, user_id, assistant_response, source):
+        """Переносит строки ДНЕВНИК: из ответа в дневник питания и возвращает очищенный ответ"""
+        assistant_response, entries = extract_diary_entries(assistant_response)
+        if entries and self.diary is not None:
+            try:
+                self.diary.append(user_id, entries, source)
+                logger.info(f"В дневник пользователя {user_id} записано блюд: {len(entries)}")
+            except sqlite3.Error as e:
+                logger.error(f"Не удалось записать дневник питания: {str(e)}")
+        return assistant_response
+
+    async def process_image(self, user_id, image, mime_type="image/jpeg", file_unique_id=None):
+        """Обрабатывает изображение еды, полученное в памяти"""
+        try:
+            phash = None
+            profile_hash = self._get_user_session(user_id).profile_hash
+            if self.photo_cache is not None and file_unique_id:
+                phash = await asyncio.to_thread(perceptual_hash, image)
+                assistant_response = self.photo_cache.get_similar(phash, profile_hash)
+                if assistant_response is not None:
+                    logger.info(f"Анализ фото {file_unique_id} найден по перцептивному хэшу")
+                    self.photo_cache.put(file_unique_id, profile_hash, phash, assistant_response)
+                    return self._remember_photo_answer(user_id, assistant_response, log_meals=False)
+                self.photo_cache.misses += 1
+
+            if PHOTO_REENCODE:
+                image, mime_type = await asyncio.to_thread(downscale_image, image, PHOTO_TARGET_SIDE)
 
             session = self._get_user_session(user_id)
-            history = copy.deepcopy(session["history"])
-            history = self._trim_history(history)
 
             # Добавляем изображение и запрос на анализ
-            history.append({
-                "role": "user",
-                "parts": [
-                    {
-                        "text": "Проанализируй это блюдо с точки зрения моей диеты. Подходит ли оно мне? Что можно улучшить?"},
-                    {
-                        "inline_data": {
-                            "mime_type": "image/jpeg",
-                            "data": image_data
-                        }
+            parts = [
+                {
+                    "text": "Проанализируй это блюдо с точки зрения моей диеты. Подходит ли оно мне? Что можно улучшить?"},
+                {
+                    "inline_data": {
+                        "mime_type": mime_type,
+                        "data": self.IMAGE_PLACEHOLDER  # base64 подставляется потоково при отправке
                     }
-                ]
-            })
-
-            request_body = {
-                "contents": history,
-                "generationConfig": {
-                    "temperature": 0.7,
-                    "maxOutputTokens": 1024,
-                },
-                "safetySettings": [
-                    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}
-                ]
-            }
-
-            response = requests.post(
-                self.API_URL,
-                headers={
-                    'Content-Type': 'application/json',
-                    'X-goog-api-key': GEMINI_API_KEY
-                },
-                json=request_body,
-                timeout=30
-            )
+                }
+            ]
+            if self.diary is not None:
+                parts.append({"text": DIARY_PHOTO_INSTRUCTION})
+            with span("payload"):
+                history = session.history.contents({"role": "user", "parts": parts})
+                request_body = self._build_request_body(history, "photo")
 
-            if response.status_code == 200:
-                data = response.json()
-                if 'candidates' in data and data['candidates']:
-                    assistant_response = data['candidates'][0]['content']['parts'][0]['text']
-
-                    # Обновляем историю
-                    session["history"].append({
-                        "role": "user",
-                        "parts": [{"text": "Пользователь отправил фото еды для анализа"}]
-                    })
-                    session["history"].append({
-                        "role": "model",
-                        "parts": [{"text": assistant_response}]
-                    })
-                    session["history"] = self._trim_history(session["history"])
-                    session["last_interaction"] = datetime.now()
-
-                    return assistant_response
+            assistant_response = await self._generate(request_body, "photo", image=image)
 
-            return "Не удалось проанализировать изображение. Попробуйте еще раз. 📸"
+            if self.photo_cache is not None and file_unique_id:
+                self.photo_cache.put(file_unique_id, profile_hash, phash, assistant_response)
 
+            # Обновляем историю и дневник
+            return self._remember_photo_answer(user_id, assistant_response)
+
+        except GeminiError:
+            record_error("gemini")
+            return "Не удалось проанализировать изображение. Попробуйте еще раз. 📸"
         except Exception as e:
+            record_error("internal")
             logger.error(f"Ошибка обработки изображения: {str(e)}")
             return "Произошла ошибка при анализе изображения. 😕"
 
-    def get_response(self, user_id, user_input):
+    def _build_request_body(self, contents, route="text"):
+        """Собирает тело запроса generateContent с общими настройками генерации и пределом маршрута"""
+        return {
+            "contents": contents,
+            "generationConfig": {
+                "temperature": 0.7,
+                "maxOutputTokens": MODEL_ROUTES[route]["max_output_tokens"],
+            },
+            "safetySettings": [
+                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}
+            ]
+        }
+
+    def _lookup_knowledge(self, user_id, user_input, route):
+        """Отвечает из локальной базы знаний или возвращает справки для запроса к Gemini"""
+        if self.knowledge is None or route not in self.USER_ROUTES:
+            return None, []
+
+        session = self._get_user_session(user_id)
+        with span("knowledge"):
+            answer, snippets = self.knowledge.lookup(user_input, session.profile_hash)
+        if answer is not None:
+            self._remember_turn(user_id, session, Turn("user", user_input), answer)
+            logger.info(f"Ответ пользователю {user_id} найден в локальной базе знаний")
+        return answer, snippets
+
+    def _prepare_text_request(self, user_id, user_input, route, snippets=()):
+        """Готовит сессию, обрезанный ввод и тело запроса для текстового вопроса"""
+        if len(user_input) > self.MAX_INPUT_LENGTH:
+            user_input = user_input[:self.MAX_INPUT_LENGTH] + "..."
+            logger.warning(f"Ввод пользователя {user_id} обрезан до {self.MAX_INPUT_LENGTH} символов")
+
+        session = self._get_user_session(user_id)
+        user_turn = Turn("user", user_input)
+        content = user_turn.content
+        # Справки и просьба о строках дневника идут только в запрос, в историю попадает исходный вопрос
+        extra = []
+        if snippets:
+            extra.append({"text": "Справка из базы знаний (используй, если уместно):\n"
+                                  + "\n".join(f"• {snippet}" for snippet in snippets)})
+        if self.diary is not None and route in self.USER_ROUTES:
+            extra.append({"text": DIARY_TEXT_INSTRUCTION})
+        if extra:
+            content = dict(content, parts=content["parts"] + extra)
+
+        with span("payload"):
+            request_body = self._build_request_body(session.history.contents(content), route)
+        return session, user_turn, request_body
+
+    def _remember_turn(self, user_id, session, user_turn, assistant_response):
+        """Добавляет вопрос и ответ в кольцевой буфер истории и дописывает их в хранилище"""
+        model_turn = Turn("model", assistant_response)
+        session.history.append(user_turn)
+        session.history.append(model_turn)
+        session.last_interaction = datetime.now()
+
+        self.session_store.append_turns(
+            user_id,
+            [(user_turn.role, user_turn.text), (model_turn.role, model_turn.text)],
+            session.last_interaction,
+            self.MAX_HISTORY_LENGTH
+        )
+        self._enforce_history_budget(user_id, session)
+
+    def _trim_to_token_limit(self, history):
+        """Жестко отбрасывает старые реплики, если история превысила HISTORY_TOKEN_LIMIT"""
+        while history.tokens > HISTORY_TOKEN_LIMIT and len(history.turns) > 2:
+            history.popleft()
+
+    def _enforce_history_budget(self, user_id, session):
+        """Держит размер запроса в пределах бюджета: сворачивает старые реплики в фоне"""
+        self._trim_to_token_limit(session.history)
+
+        if session.history.tokens <= HISTORY_TOKEN_BUDGET or user_id in self.summary_tasks:
+            return
+
+        task = asyncio.get_running_loop().create_task(self._summarize_history(user_id, session))
+        self.summary_tasks[user_id] = task
+        task.add_done_callback(lambda t: self._forget_summary(user_id, t))
+
+    def _forget_summary(self, user_id, task):
+        # После сброса у пользователя может идти уже новая свертка — ее не трогаем
+        if self.summary_tasks.get(user_id) is task:
+            del self.summary_tasks[user_id]
+
+    def _cancel_summary(self, user_id):
+        """Останавливает свертку истории сессии, которую удаляют"""
+        task = self.summary_tasks.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def _count_tokens(self, contents):
+        """Точный подсчет токенов через countTokens"""
+        response = await self._get_http_client().post(
+            f"{GEMINI_API_BASE}/models/{GEMINI_MODEL}:countTokens",
+            json={"contents": contents},
+            extensions={"trace": self.pool_stats.trace_for_request()}
+        )
+        response.raise_for_status()
+        return response.json()["totalTokens"]
+
+    async def _summarize_history(self, user_id, session):
+        """Сворачивает старейшие реплики в краткое содержание, пока остаток не уложится в полбюджета"""
+        history = session.history
+        folded = []
+        remaining = history.tokens
+        for turn in history.turns:
+            # Сворачиваем парами вопрос-ответ, чтобы история начиналась с вопроса
+            if remaining <= HISTORY_TOKEN_BUDGET // 2 and turn.role == "user":
+                break
+            folded.append(turn)
+            remaining -= turn.tokens
+        if not folded or len(folded) == len(history.turns):
+            return
+
+        if HISTORY_COUNT_TOKENS:
+            try:
+                tokens = await self._count_tokens([turn.content for turn in folded])
+                token_estimator.calibrate(sum(len(turn.text) for turn in folded), tokens)
+            except (httpx.HTTPError, KeyError, ValueError) as e:
+                logger.warning(f"countTokens недоступен: {str(e)}")
+
+        transcript = "\n\n".join(
+            f"{'Пользователь' if turn.role == 'user' else 'Ассистент'}: {turn.text}" for turn in folded
+        )
+        previous = history.summary.text[len(self.SUMMARY_PREFIX):] if history.summary else ""
+        prompt = (
+            "Сожми диалог пациента с нутрициологом в краткое содержание на русском языке (до 10 пунктов). "
+            "Сохрани факты о самочувствии, предпочтениях, съеденных блюдах и данных рекомендациях.\n\n"
+            + (f"Прежнее краткое содержание:\n{previous}\n\n" if previous else "")
+            + f"Новые реплики:\n{transcript}"
+        )
+
         try:
-            if len(user_input) > self.MAX_INPUT_LENGTH:
-                user_input = user_input[:self.MAX_INPUT_LENGTH] + "..."
-                logger.warning(f"Ввод пользователя {user_id} обрезан до {self.MAX_INPUT_LENGTH} символов")
+            summary = await self._generate(self._build_request_body(
+                [{"role": "user", "parts": [{"text": prompt}]}], "summary"
+            ), "summary")
+        except GeminiError:
+            logger.warning(f"Не удалось свернуть историю пользователя {user_id}")
+            return
+
+        if self.user_sessions.get(user_id) is not session:
+            # Сессию сбросили или вытеснили, пока шла свертка: в строку новой сессии не пишем
+            logger.info(f"Свертка истории пользователя {user_id} отброшена: сессия сменилась")
+            return
+
+        history.fold(folded, Turn("user", self.SUMMARY_PREFIX + summary.strip()))
+        self.session_store.update_summary(user_id, history.summary.text, len(history.turns))
+        logger.info(
+            f"История пользователя {user_id} свернута: {len(folded)} реплик в краткое содержание, "
+            f"осталось ~{history.tokens} токенов"
+        )
 
-            session = self._get_user_session(user_id)
-            history = copy.deepcopy(session["history"])
-            history = self._trim_history(history)
-
-            history.append({
-                "role": "user",
-                "parts": [{"text": user_input}]
-            })
-
-            request_body = {
-                "contents": history,
-                "generationConfig": {
-                    "temperature": 0.7,
-                    "maxOutputTokens": 1024,
-                },
-                "safetySettings": [
-                    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}
-                ]
-            }
-
-            logger.debug(f"Отправка запроса к Gemini API: {json.dumps(request_body, ensure_ascii=False)[:200]}...")
-
-            response = requests.post(
-                self.API_URL,
-                headers={
-                    'Content-Type': 'application/json',
-                    'X-goog-api-key': GEMINI_API_KEY
-                },
-                json=request_body,
-                timeout=30
-            )
+    def _estimate_request_tokens(self, request_body):
+        """Оценка токенов запроса для бюджета: входной текст, изображение и максимум ответа"""
+        tokens = request_body["generationConfig"]["maxOutputTokens"]
+        for content in request_body["contents"]:
+            for part in content["parts"]:
+                tokens += token_estimator.estimate(part["text"]) if "text" in part else self.IMAGE_TOKENS
+        return tokens
+
+    def _record_usage(self, route, reserved, usage):
+        """Учитывает расход токенов маршрута и возвращает в бюджет лишний резерв"""
+        self.routes[route].record_usage(usage)
+        used = usage.get("totalTokenCount")
+        if used:
+            self.admission.refund(reserved - used)
+
+    async def _generate(self, request_body, route, image=None):
+        """Выполняет generateContent и возвращает текст ответа или выбрасывает GeminiError"""
+        logger.debug("Отправка запроса к Gemini API: %s...", LazyJson(request_body))
+
+        reserved = self._estimate_request_tokens(request_body)
+        try:
+            with span("gemini", route=route):
+                response = await self._post_gemini(request_body, route, image=image, reserved=reserved)
+        except httpx.TimeoutException:
+            logger.error("Таймаут при запросе к Gemini API")
+            raise GeminiError("Превышено время ожидания ответа. Попробуйте позже. ⏰")
+        except httpx.TransportError:
+            logger.error("Ошибка подключения к Gemini API")
+            raise GeminiError("Проблемы с подключением к сервису. Проверьте интернет-соединение. 🌐")
 
-            logger.info(f"Статус ответа Gemini: {response.status_code}")
+        logger.info(f"Статус ответа Gemini: {response.status_code}")
 
-            if response.status_code != 200:
-                logger.error(f"Ошибка Gemini API: {response.text}")
-                return "Извините, произошла ошибка при обращении к AI-сервису. Попробуйте позже. 😔"
+        if response.status_code != 200:
+            logger.error(f"Ошибка Gemini API: {response.text}")
+            raise GeminiError("Извините, произошла ошибка при обращении к AI-сервису. Попробуйте позже. 😔")
 
-            data = response.json()
+        data = response.json()
+        self._record_usage(route, reserved, data.get("usageMetadata", {}))
 
-            if 'promptFeedback' in data and 'blockReason' in data['promptFeedback']:
-                reason = data['promptFeedback']['blockReason']
-                logger.warning(f"Запрос заблокирован: {reason}")
-                return "Запрос содержит недопустимый контент. Пожалуйста, переформулируйте вопрос. ⚠️"
+        if 'promptFeedback' in data and 'blockReason' in data['promptFeedback']:
+            reason = data['promptFeedback']['blockReason']
+            logger.warning(f"Запрос заблокирован: {reason}")
+            raise GeminiError("Запрос содержит недопустимый контент. Пожалуйста, переформулируйте вопрос. ⚠️")
 
-            if 'candidates' not in data or not data['candidates']:
-                logger.error("Нет кандидатов в ответе API")
-                return "Не удалось получить ответ. Пожалуйста, переформулируйте вопрос. 🤔"
+        if 'candidates' not in data or not data['candidates']:
+            logger.error("Нет кандидатов в ответе API")
+            raise GeminiError("Не удалось получить ответ. Пожалуйста, переформулируйте вопрос. 🤔")
 
-            candidate = data['candidates'][0]
-            if 'content' not in candidate or 'parts' not in candidate['content']:
-                logger.error("Неверная структура ответа API")
-                return "Ошибка обработки ответа. Попробуйте снова. 😕"
+        candidate = data['candidates'][0]
+        if 'content' not in candidate or 'parts' not in candidate['content']:
+            logger.error("Неверная структура ответа API")
+            raise GeminiError("Ошибка обработки ответа. Попробуйте снова. 😕")
 
-            assistant_response = candidate['content']['parts'][0]['text']
+        return candidate['content']['parts'][0]['text']
+
+    async def get_response(self, user_id, user_input, route=None):
+        try:
+            route = route or pick_route(user_input)
+            answer, snippets = self._lookup_knowledge(user_id, user_input, route)
+            if answer is not None:
+                return answer
+
+            session, user_turn, request_body = self._prepare_text_request(user_id, user_input, route, snippets)
+            assistant_response = await self._generate(request_body, route)
+            assistant_response = self._log_meals(user_id, assistant_response, "text")
 
             # Обновляем историю с обрезкой
-            session["history"].append({
-                "role": "user",
-                "parts": [{"text": user_input}]
-            })
-            session["history"].append({
-                "role": "model",
-                "parts": [{"text": assistant_response}]
-            })
-
-            session["history"] = self._trim_history(session["history"])
-            session["last_interaction"] = datetime.now()
+            self._remember_turn(user_id, session, user_turn, assistant_response)
 
             logger.info(f"Ответ получен ({len(assistant_response)} символов)")
             return assistant_response
 
-        except requests.exceptions.Timeout:
-            logger.error("Таймаут при запросе к Gemini API")
-            return "Превышено время ожидания ответа. Попробуйте позже. ⏰"
-        except requests.exceptions.ConnectionError:
-            logger.error("Ошибка подключения к Gemini API")
-            return "Проблемы с подключением к сервису. Проверьте интернет-соединение. 🌐"
+        except GeminiError as e:
+            record_error("gemini")
+            return e.user_message
         except Exception as e:
+            record_error("internal")
             logger.error(f"Исключение в get_response: {str(e)}")
             return "Произошла непредвиденная ошибка. Пожалуйста, попробуйте позже. 😟"
 
+    def _quick_answer_key(self, callback_data, session):
+        """Ключ кэша: кнопка, дата, профиль и, по желанию, отпечаток истории"""
+        profile_hash = session.profile_hash if session is not None else DEFAULT_PROFILE_HASH
+        key = (callback_data, datetime.now().strftime("%Y-%m-%d"), profile_hash)
+        if ANSWER_CACHE_BY_HISTORY:
+            key += (session.history.fingerprint(),)
+        return key
+
+    def _generate_quick_answer(self, callback_data, prompt_turn, history):
+        """Возвращает корутину генерации ответа на кнопку по системному промпту"""
+        if ANSWER_CACHE_BY_HISTORY:
+            contents = history.contents(prompt_turn.content)
+        else:
+            # Ответ зависит только от дня и профиля, поэтому одинаков для всех
+            contents = [history.system.content, prompt_turn.content]
+        route = pick_route(callback_data=callback_data)
+        return self._generate(self._build_request_body(contents, route), route)
+
+    async def get_quick_answer(self, user_id, callback_data, prompt):
+        """Ответ на кнопку быстрого действия через общий дневной кэш"""
+        try:
+            session = self._get_user_session(user_id)
+            key = self._quick_answer_key(callback_data, session)
+            prompt_turn = Turn("user", prompt)
+
+            assistant_response = await self.answer_cache.get_or_create(
+                key, lambda: self._generate_quick_answer(callback_data, prompt_turn, session.history)
+            )
+
+            self._remember_turn(user_id, session, prompt_turn, assistant_response)
+            return assistant_response
+
+        except GeminiError as e:
+            record_error("gemini")
+            return e.user_message
+        except Exception as e:
+            record_error("internal")
+            logger.error(f"Исключение в get_quick_answer: {str(e)}")
+            return "Произошла непредвиденная ошибка. Пожалуйста, попробуйте позже. 😟"
+
+    async def prefetch_quick_answers(self, prompts, concurrency=WARMUP_CONCURRENCY):
+        """Заранее генерирует ответы на кнопки текущего дня; возвращает (успешно, с ошибкой)"""
+        if ANSWER_CACHE_BY_HISTORY:
+            logger.info("Прогрев пропущен: ответы на кнопки зависят от истории пользователя")
+            return 0, 0
+
+        history = self._new_history()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def prefetch(callback_data, prompt):
+            async with semaphore:
+                key = self._quick_answer_key(callback_data, None)
+                try:
+                    await self.answer_cache.get_or_create(
+                        key, lambda: self._generate_quick_answer(callback_data, Turn("user", prompt), history)
+                    )
+                    return True
+                except GeminiError:
+                    logger.warning(f"Не удалось заранее подготовить ответ на кнопку {callback_data}")
+                    return False
+
+        results = await asyncio.gather(*(prefetch(data, prompt) for data, prompt in prompts.items()))
+        ok = sum(results)
+
+        try:
+            await asyncio.to_thread(self.answer_cache.save)
+        except OSError as e:
+            logger.error(f"Не удалось сохранить кэш ответов: {str(e)}")
+
+        return ok, len(results) - ok
+
+    async def stream_response(self, user_id, user_input, route=None):
+        """Потоково получает ответ через streamGenerateContent (SSE), отдавая текст по кускам"""
+        chunks = []
+        shown = 0
+        try:
+            route = route or pick_route(user_input)
+            answer, snippets = self._lookup_knowledge(user_id, user_input, route)
+            if answer is not None:
+                yield answer
+                return
+
+            session, user_turn, request_body = self._prepare_text_request(user_id, user_input, route, snippets)
+            reserved = self._estimate_request_tokens(request_body)
+            usage = {}
+            started = time.monotonic()
+
+            async with self._stream_gemini(request_body, route, reserved) as response:
+                record_span("gemini_stream_open", time.monotonic() - started)
+                logger.info(f"Статус потокового ответа Gemini: {response.status_code}")
+
+                if response.status_code != 200:
+                    await response.aread()
+                    record_error("gemini")
+                    logger.error(f"Ошибка Gemini API: {response.text}")
+                    yield "Извините, произошла ошибка при обращении к AI-сервису. Попробуйте позже. 😔"
+                    return
+
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+
+                    data = json.loads(line[len("data:"):])
+                    usage = data.get("usageMetadata", usage)
+
+                    if 'promptFeedback' in data and 'blockReason' in data['promptFeedback']:
+                        record_error("gemini")
+                        logger.warning(f"Запрос заблокирован: {data['promptFeedback']['blockReason']}")
+                        yield "Запрос содержит недопустимый контент. Пожалуйста, переформулируйте вопрос. ⚠️"
+                        return
+
+                    for candidate in data.get('candidates', []):
+                        for part in candidate.get('content', {}).get('parts', []):
+                            text = part.get('text')
+                            if text:
+                                if not chunks:
+                                    record_span("gemini_first_chunk", time.monotonic() - started)
+                                chunks.append(text)
+                                # Строки ДНЕВНИК: пользователю не показываем
+                                visible = visible_stream_length("".join(chunks))
+                                if visible > shown:
+                                    yield "".join(chunks)[shown:visible]
+                                    shown = visible
+
+            self.routes[route].latency.add(time.monotonic() - started)
+            record_span("gemini_stream", time.monotonic() - started)
+            self._record_usage(route, reserved, usage)
+            if not chunks:
+                record_error("gemini")
+                logger.error("Нет кандидатов в потоковом ответе API")
+                yield "Не удалось получить ответ. Пожалуйста, переформулируйте вопрос. 🤔"
+                return
+
+            assistant_response = self._log_meals(user_id, "".join(chunks), "text")
+            if len(assistant_response) > shown:
+                yield assistant_response[shown:]
+            self._remember_turn(user_id, session, user_turn, assistant_response)
+            logger.info(f"Потоковый ответ получен ({len(assistant_response)} символов)")
+
+        except GeminiError as e:
+            record_error("gemini")
+            yield ("\n\n" if chunks else "") + e.user_message
+        except httpx.TimeoutException:
+            record_error("gemini")
+            logger.error("Таймаут при потоковом запросе к Gemini API")
+            yield ("\n\n" if chunks else "") + "Превышено время ожидания ответа. Попробуйте позже. ⏰"
+        except httpx.TransportError:
+            record_error("gemini")
+            logger.error("Ошибка подключения к Gemini API")
+            yield ("\n\n" if chunks else "") + "Проблемы с подключением к сервису. Проверьте интернет-соединение. 🌐"
+        except Exception as e:
+            record_error("internal")
+            logger.error(f"Исключение в stream_response: {str(e)}")
+            yield ("\n\n" if chunks else "") + "Произошла непредвиденная ошибка. Пожалуйста, попробуйте позже. 😟"
+
 
 # =====================================================================
 # ИНИЦИАЛИЗАЦИЯ АССИСТЕНТА
 # =====================================================================
-assistant = NutritionAssistant()
+assistant = NutritionAssistant(create_session_store())
+
+
+def collect_assistant_metrics():
+    """Попадания кэшей и показатели компонентов ассистента на момент выгрузки метрик"""
+    caches = {
+        "answer": (assistant.answer_cache.hits, assistant.answer_cache.misses),
+        "context": (assistant.context_cache.reused, assistant.context_cache.created),
+    }
+    if assistant.photo_cache is not None:
+        photo_cache = assistant.photo_cache
+        caches["photo"] = (photo_cache.hits + photo_cache.similar_hits, photo_cache.misses)
+    if assistant.knowledge is not None:
+        knowledge = assistant.knowledge
+        caches["knowledge"] = (knowledge.answered, knowledge.lookups - knowledge.answered)
+    for cache, (hits, misses) in caches.items():
+        yield "bot_cache_hits_total", (("cache", cache),), hits
+        yield "bot_cache_misses_total", (("cache", cache),), misses
+
+    components = {"pool": assistant.pool_stats, "admission": assistant.admission, "breaker": assistant.breaker}
+    components.update((f"route_{name}", stats) for name, stats in assistant.routes.items())
+    if assistant.diary is not None:
+        components["diary"] = assistant.diary
+    for component, source in components.items():
+        yield from component_samples(component, source)
+
+
+metrics.collectors.append(collect_assistant_metrics)
 
 
 # =====================================================================
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # =====================================================================
 
-async def send_long_message(context, chat_id, text, reply_markup=None):
-    MAX_LENGTH = 4096
+MAX_MESSAGE_LENGTH = 4096
+
 
+def split_message(text, max_length=MAX_MESSAGE_LENGTH):
+    """Разбивает текст на части не длиннее лимита Telegram по переносам строк и пробелам"""
     parts = []
     while text:
-        if len(text) <= MAX_LENGTH:
+        if len(text) <= max_length:
             parts.append(text)
             break
 
-        split_index = text.rfind('\n', 0, MAX_LENGTH)
+        split_index = text.rfind('\n', 0, max_length)
         if split_index == -1:
-            split_index = text.rfind(' ', 0, MAX_LENGTH)
+            split_index = text.rfind(' ', 0, max_length)
             if split_index == -1:
-                split_index = MAX_LENGTH
+                split_index = max_length
 
         parts.append(text[:split_index])
         text = text[split_index:].lstrip()
 
+    return parts
+
+
+async def send_long_message(context, chat_id, text, reply_markup=None):
+    parts = split_message(text)
+
     for i, part in enumerate(parts):
         markup = reply_markup if i == len(parts) - 1 else None
+        # Паузы между частями выдерживает TelegramRateLimiter, не блокируя цикл событий
         await context.bot.send_message(
             chat_id=chat_id,
             text=part,
             reply_markup=markup
         )
-        time.sleep(0.3)
+
+
+def _retry_after_seconds(error):
+    """Возвращает паузу из RetryAfter в секундах (int или timedelta в разных версиях PTB)"""
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+class StreamingReply:
+    """Показывает потоковый ответ, редактируя сообщение не чаще STREAM_EDIT_INTERVAL"""
+    PLACEHOLDER = "✍️ Готовлю ответ..."
+
+    def __init__(self, bot, chat_id, message=None, reply_markup=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message = message
+        self.reply_markup = reply_markup
+        self.text = ""
+        self.shown = None
+        self.next_edit_at = 0.0
+
+    async def start(self):
+        if self.message is None:
+            self.message = await self.bot.send_message(chat_id=self.chat_id, text=self.PLACEHOLDER)
+            self.shown = self.PLACEHOLDER
+        else:
+            await self._edit(self.PLACEHOLDER)
+
+    async def feed(self, chunk):
+        self.text += chunk
+        if time.monotonic() >= self.next_edit_at:
+            await self._render()
+
+    async def finish(self):
+        await self._render(final=True)
+
+    async def _render(self, final=False):
+        parts = split_message(self.text)
+        if not parts:
+            return
+
+        # Переполненное сообщение фиксируем и продолжаем в новом
+        if len(parts) > 1:
+            await self._edit(parts[0], final=True)
+            for part in parts[1:-1]:
+                await self.bot.send_message(chat_id=self.chat_id, text=part)
+            self.message = await self.bot.send_message(chat_id=self.chat_id, text=parts[-1])
+            self.shown = parts[-1]
+            self.text = parts[-1]
+
+        if final or self.text != self.shown:
+            await self._edit(self.text, reply_markup=self.reply_markup if final else None, final=final)
+        self.next_edit_at = time.monotonic() + STREAM_EDIT_INTERVAL
+
+    async def _edit(self, text, reply_markup=None, final=False):
+        if text == self.shown and reply_markup is None:
+            return
+        try:
+            # Итоговую правку ограничитель повторит сам, промежуточную повторять незачем.
+            # rate_limit_args принимают только методы бота, не сокращения Message
+            await self.bot.edit_message_text(
+                text, chat_id=self.message.chat_id, message_id=self.message.message_id,
+                reply_markup=reply_markup,
+                rate_limit_args=None if final else TelegramRateLimiter.NO_RETRY
+            )
+            self.shown = text
+        except RetryAfter as e:
+            if final:
+                raise
+            # Промежуточную правку пропускаем, покажем текст позже
+            self.next_edit_at = time.monotonic() + _retry_after_seconds(e)
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return
+            logger.warning(f"Не удалось отредактировать сообщение: {str(e)}")
+            self.message = await self.bot.send_message(chat_id=self.chat_id, text=text, reply_markup=reply_markup)
+            self.shown = text
+
+
+async def send_streaming_response(context, chat_id, chunks, reply_markup=None, message=None):
+    """Выводит потоковый ответ в чат и возвращает итоговую длину текста"""
+    reply = StreamingReply(context.bot, chat_id, message=message, reply_markup=reply_markup)
+    await reply.start()
+
+    total = 0
+    async for chunk in chunks:
+        total += len(chunk)
+        await reply.feed(chunk)
+
+    await reply.finish()
+    return total
+
+
+def pick_photo_size(photos, target_side):
+    """Выбирает наименьший PhotoSize с длинной стороной не меньше target_side (иначе самый большой)"""
+    for photo in sorted(photos, key=lambda p: p.width * p.height):
+        if max(photo.width, photo.height) >= target_side:
+            return photo
+    return max(photos, key=lambda p: p.width * p.height)
+
+
+def downscale_image(image, max_side):
+    """Уменьшает и пережимает изображение в JPEG; без Pillow возвращает его как есть"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return image, "image/jpeg"
+
+    with Image.open(io.BytesIO(image)) as picture:
+        picture.thumbnail((max_side, max_side))
+        output = io.BytesIO()
+        picture.convert("RGB").save(output, format="JPEG", quality=PHOTO_JPEG_QUALITY, optimize=True)
+    return output.getbuffer(), "image/jpeg"
+
+
+QUICK_ACTIONS = ["menu_today", "supplements", "activity", "shopping_list", "water", "diary"]
+
+
+def format_diary_summary(diary, user_id, today=None):
+    """Сводка дневника за день и неделю, посчитанная локально без обращения к Gemini"""
+    today = today or datetime.now().date()
+    week_start = today - timedelta(days=DIARY_WEEK_DAYS - 1)
+    date = today.strftime("%Y-%m-%d")
+    meals = diary.day(user_id, date)
+    days = diary.totals(user_id, week_start.strftime("%Y-%m-%d"), date)
+    flags = diary.flag_counts(user_id, week_start.strftime("%Y-%m-%d"), date)
+    diary.summaries += 1
+
+    lines = ["📊 Дневник питания", ""]
+    if not days:
+        lines.append("Записей пока нет.")
+    else:
+        today_totals = next((row for row in days if row[0] == date), None)
+        if today_totals is None:
+            lines.append(f"Сегодня ({today.strftime('%d.%m')}) записей нет.")
+        else:
+            _, count, calories, protein, fat, carbs = today_totals
+            lines.append(
+                f"Сегодня ({today.strftime('%d.%m')}): блюд {count}, ~{calories:.0f} ккал "
+                f"(Б {protein:.0f} г, Ж {fat:.0f} г, У {carbs:.0f} г)"
+            )
+            for clock, meal, dish, dish_calories in meals:
+                kcal = f" — ~{dish_calories:.0f} ккал" if dish_calories else ""
+                lines.append(f"• {clock} {meal + ': ' if meal else ''}{dish}{kcal}")
+
+        week_calories = sum(row[2] for row in days)
+        lines.append("")
+        lines.append(
+            f"За {DIARY_WEEK_DAYS} дн.: записано дней {len(days)}, "
+            f"в среднем ~{week_calories / len(days):.0f} ккал в день"
+        )
+        if flags:
+            lines.append("Нежелательные продукты: " + ", ".join(f"{flag} ×{count}" for flag, count in flags))
+
+    lines.append("")
+    lines.append("Чтобы пополнить дневник, напишите, что съели, или пришлите фото блюда.")
+    return "\n".join(lines)
+
+
+def get_quick_action_prompt(data):
+    """Возвращает запрос к ассистенту для кнопки быстрого действия"""
+    current_day = datetime.now().strftime("%A")
+    day_names = {
+        "Monday": "понедельник", "Tuesday": "вторник", "Wednesday": "среда",
+        "Thursday": "четверг", "Friday": "пятница", "Saturday": "суббота", "Sunday": "воскресенье"
+    }
+    day_ru = day_names.get(current_day, current_day)
+
+    if data == "menu_today":
+        return f"Составь персональное меню на {day_ru} с учетом моих потребностей. Учти особенности этого дня недели."
+    elif data == "supplements":
+        return "Какие добавки и витамины мне особенно важны сегодня? Учти дефициты из моего отчета и время года."
+    elif data == "activity":
+        return f"Какая физическая активность мне подойдет в {day_ru}? Учти проблемы с позвоночником и день недели."
+    elif data == "shopping_list":
+        return "Создай список покупок на неделю с учетом моих диетических рекомендаций и сезонности."
+    elif data == "water":
+        return "Как мне поддерживать водный баланс сегодня? Учти мой водно-электролитный дисбаланс и погодные условия."
+    elif data == "diary":
+        return "Помоги мне вести дневник питания. Что важно отслеживать при моих особенностях здоровья?"
+    else:
+        return "Помоги мне с персональными рекомендациями на сегодня"
 
 
 def get_quick_actions_keyboard():
@@ -488,6 +3410,7 @@ def get_quick_actions_keyboard():
 # ОБРАБОТЧИКИ КОМАНД
 # =====================================================================
 
+@instrument("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user = update.effective_user
@@ -522,10 +3445,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info("Приветственное сообщение отправлено")
 
     except Exception as e:
+        record_error("handler")
         logger.error(f"Ошибка в start: {str(e)}", exc_info=True)
         await update.message.reply_text("⚠️ Произошла ошибка. Попробуйте команду /start снова.")
 
 
+@instrument("message")
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user = update.effective_user
@@ -534,7 +3459,17 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
 
-        response = assistant.get_response(user.id, user_input)
+        if GEMINI_STREAMING:
+            total = await send_streaming_response(
+                context,
+                update.effective_chat.id,
+                assistant.stream_response(user.id, user_input),
+                get_quick_actions_keyboard()
+            )
+            logger.info(f"Потоковый ответ отправлен ({total} символов)")
+            return
+
+        response = await assistant.get_response(user.id, user_input)
         logger.info(f"Получен ответ ({len(response)} символов)")
 
         if len(response) > 4000:
@@ -554,54 +3489,58 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info("Ответ успешно отправлен")
 
     except Exception as e:
+        record_error("handler")
         logger.error(f"Ошибка обработки сообщения: {str(e)}", exc_info=True)
         await update.message.reply_text("⚠️ Произошла ошибка при обработке вашего сообщения.")
 
 
+@instrument("photo")
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user = update.effective_user
         logger.info(f"Получено фото от {user.id}")
 
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-        await update.message.reply_text("📸 Анализирую ваше блюдо... Это может занять несколько секунд.")
+        # Берем наименьший размер, которого достаточно для анализа
+        photo = pick_photo_size(update.message.photo, PHOTO_TARGET_SIDE)
 
-        # Получаем файл
-        photo = update.message.photo[-1]  # Берем самое качественное фото
-        file = await context.bot.get_file(photo.file_id)
+        # Повторное фото отвечаем из кэша без загрузки и запроса к Gemini
+        response = assistant.lookup_photo(user.id, photo.file_unique_id)
 
-        # Скачиваем файл
-        file_path = f"temp_photo_{user.id}_{int(time.time())}.jpg"
-        await file.download_to_drive(file_path)
+        if response is None:
+            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+            await update.message.reply_text("📸 Анализирую ваше блюдо... Это может занять несколько секунд.")
+
+            # Скачиваем файл в память, без временных файлов на диске
+            with span("download"):
+                file = await context.bot.get_file(photo.file_id)
+                image = await file.download_as_bytearray()
+            logger.info(f"Фото {photo.width}x{photo.height} загружено ({len(image)} байт)")
 
-        try:
             # Обрабатываем изображение
-            response = await assistant.process_image(user.id, file_path)
+            response = await assistant.process_image(user.id, image, file_unique_id=photo.file_unique_id)
 
-            if len(response) > 4000:
-                await send_long_message(
-                    context,
-                    update.effective_chat.id,
-                    response,
-                    get_quick_actions_keyboard()
-                )
-            else:
-                await update.message.reply_text(
-                    response,
-                    reply_markup=get_quick_actions_keyboard()
-                )
-        finally:
-            # Удаляем временный файл
-            if os.path.exists(file_path):
-                os.remove(file_path)
+        if len(response) > 4000:
+            await send_long_message(
+                context,
+                update.effective_chat.id,
+                response,
+                get_quick_actions_keyboard()
+            )
+        else:
+            await update.message.reply_text(
+                response,
+                reply_markup=get_quick_actions_keyboard()
+            )
 
         logger.info("Фото обработано и ответ отправлен")
 
     except Exception as e:
+        record_error("handler")
         logger.error(f"Ошибка обработки фото: {str(e)}", exc_info=True)
         await update.message.reply_text("⚠️ Произошла ошибка при анализе фотографии. Попробуйте еще раз.")
 
 
+@instrument("button")
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         query = update.callback_query
@@ -612,29 +3551,24 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
 
-        current_day = datetime.now().strftime("%A")
-        day_names = {
-            "Monday": "понедельник", "Tuesday": "вторник", "Wednesday": "среда",
-            "Thursday": "четверг", "Friday": "пятница", "Saturday": "суббота", "Sunday": "воскресенье"
-        }
-        day_ru = day_names.get(current_day, current_day)
+        prompt = get_quick_action_prompt(data)
 
-        if data == "menu_today":
-            prompt = f"Составь персональное меню на {day_ru} с учетом моих потребностей. Учти особенности этого дня недели."
-        elif data == "supplements":
-            prompt = "Какие добавки и витамины мне особенно важны сегодня? Учти дефициты из моего отчета и время года."
-        elif data == "activity":
-            prompt = f"Какая физическая активность мне подойдет в {day_ru}? Учти проблемы с позвоночником и день недели."
-        elif data == "shopping_list":
-            prompt = "Создай список покупок на неделю с учетом моих диетических рекомендаций и сезонности."
-        elif data == "water":
-            prompt = "Как мне поддерживать водный баланс сегодня? Учти мой водно-электролитный дисбаланс и погодные условия."
-        elif data == "diary":
-            prompt = "Помоги мне вести дневник питания. Что важно отслеживать при моих особенностях здоровья?"
+        if data == "diary" and assistant.diary is not None:
+            response = format_diary_summary(assistant.diary, user.id)
+        elif ANSWER_CACHE_ENABLED:
+            response = await assistant.get_quick_answer(user.id, data, prompt)
+        elif GEMINI_STREAMING:
+            total = await send_streaming_response(
+                context,
+                update.effective_chat.id,
+                assistant.stream_response(user.id, prompt, route=pick_route(callback_data=data)),
+                get_quick_actions_keyboard(),
+                message=query.message
+            )
+            logger.info(f"Потоковый ответ отправлен ({total} символов)")
+            return
         else:
-            prompt = "Помоги мне с персональными рекомендациями на сегодня"
-
-        response = assistant.get_response(user.id, prompt)
+            response = await assistant.get_response(user.id, prompt, route=pick_route(callback_data=data))
         logger.info(f"Получен ответ ({len(response)} символов)")
 
         if len(response) > 4000:
@@ -662,6 +3596,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info("Сообщение обновлено")
 
     except Exception as e:
+        record_error("handler")
         logger.error(f"Ошибка обработки кнопки: {str(e)}", exc_info=True)
         try:
             await query.edit_message_text("⚠️ Произошла ошибка. Пожалуйста, попробуйте другой запрос.")
@@ -672,6 +3607,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
 
 
+@instrument("test")
 async def test_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user = update.effective_user
@@ -680,13 +3616,69 @@ async def test_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         current_date = datetime.now().strftime("%d.%m.%Y %H:%M")
         session_info = ""
 
-        if user.id in assistant.user_sessions:
-            session = assistant.user_sessions[user.id]
-            history_len = len(session["history"])
-            last_interaction = session["last_interaction"].strftime("%H:%M")
-            date_created = session.get("date_created", "неизвестно")
+        session = assistant.find_session(user.id)
+        if session is not None:
+            history_len = len(session.history)
+            last_interaction = session.last_interaction.strftime("%H:%M")
+            date_created = session.date_created or "неизвестно"
             session_info = f"📊 История: {history_len} сообщений\n🕐 Последнее: {last_interaction}\n📅 Создана: {date_created}\n"
 
+        pool = assistant.pool_stats
+        pool_info = (
+            f"🔌 Запросов к Gemini: {pool.requests}, новых соединений: {pool.handshakes}, "
+            f"повторное использование: {pool.reuse_ratio:.0%}\n"
+        )
+        breaker = assistant.breaker
+        pool_info += (
+            f"🛡 Gemini: цепь {breaker.state}, повторов {assistant.retries}, "
+            f"дублирующих запросов {assistant.hedged}\n"
+        )
+        routes = ", ".join(
+            f"{name} {stats.requests}" for name, stats in assistant.routes.items() if stats.requests
+        )
+        pool_info += f"🧭 Запросов по маршрутам: {routes or 'пока нет'}\n"
+        admission = assistant.admission.as_dict()
+        pool_info += (
+            f"🚦 Очередь к Gemini: ждут {admission['waiting']}, среднее ожидание {admission['avg_wait_ms']} мс, "
+            f"отклонено {admission['rejected'] + admission['timed_out']}\n"
+        )
+        cache = assistant.answer_cache
+        pool_info += (
+            f"🗂 Кэш кнопок: попаданий {cache.hits}, промахов {cache.misses}, "
+            f"объединено {cache.coalesced}\n"
+        )
+        if assistant.photo_cache is not None:
+            photo_cache = assistant.photo_cache.as_dict()
+            pool_info += (
+                f"📸 Кэш фото: попаданий {photo_cache['hits'] + photo_cache['similar_hits']}, "
+                f"промахов {photo_cache['misses']}\n"
+            )
+        update_processor = context.application.update_processor
+        if isinstance(update_processor, PerUserUpdateProcessor) and update_processor.latest_wins:
+            pool_info += f"⏭ Отменено устаревших нажатий: {update_processor.superseded}\n"
+        rate_limiter = context.bot.rate_limiter
+        if isinstance(rate_limiter, TelegramRateLimiter):
+            pool_info += (
+                f"📤 Отправок в Telegram: {rate_limiter.requests}, отложено {rate_limiter.delayed}, "
+                f"429: {rate_limiter.retry_after}, таймаутов {rate_limiter.timeouts}\n"
+            )
+        context_cache = assistant.context_cache
+        pool_info += (
+            f"🧠 Кэш контекста Gemini: создано {context_cache.created}, "
+            f"использований {context_cache.reused}, откатов {context_cache.fallbacks}\n"
+        )
+        if assistant.knowledge is not None:
+            knowledge = assistant.knowledge.as_dict()
+            pool_info += (
+                f"📚 База знаний: ответов без Gemini {knowledge['answered']} из {knowledge['lookups']} "
+                f"({knowledge['local_ratio']:.0%}), p50 {knowledge['p50_ms']} мс\n"
+            )
+        if assistant.diary is not None:
+            pool_info += (
+                f"📊 Дневник: записано блюд {assistant.diary.entries_logged}, "
+                f"сводок без Gemini {assistant.diary.summaries}\n"
+            )
+
         response = (
             f"🔧 Тест успешен! Бот работает правильно.\n\n"
             f"⏰ Текущее время: {current_date}\n"
@@ -695,24 +3687,26 @@ async def test_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"👤 Имя: {user.full_name}\n"
             f"📱 Username: @{user.username if user.username else 'отсутствует'}\n\n"
             f"{session_info}"
+            f"{pool_info}\n"
             f"🤖 Версия: Улучшенная с поддержкой изображений"
         )
 
         await update.message.reply_text(response, parse_mode="Markdown")
 
     except Exception as e:
+        record_error("handler")
         logger.error(f"Ошибка в test_command: {str(e)}", exc_info=True)
         await update.message.reply_text("⚠️ Произошла ошибка при выполнении теста.")
 
 
+@instrument("reset")
 async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Сброс сессии пользователя"""
     try:
         user = update.effective_user
         logger.info(f"Обработка /reset от {user.id}")
 
-        if user.id in assistant.user_sessions:
-            del assistant.user_sessions[user.id]
+        if assistant.reset_session(user.id):
             response = "🔄 Ваша сессия сброшена! Все рекомендации будут обновлены с учетом сегодняшнего дня."
         else:
             response = "ℹ️ У вас нет активной сессии для сброса."
@@ -720,10 +3714,51 @@ async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(response, reply_markup=get_quick_actions_keyboard())
 
     except Exception as e:
+        record_error("handler")
         logger.error(f"Ошибка в reset_command: {str(e)}", exc_info=True)
         await update.message.reply_text("⚠️ Произошла ошибка при сбросе сессии.")
 
 
+# =====================================================================
+# ФОНОВЫЕ ЗАДАЧИ
+# =====================================================================
+
+async def warmup_quick_answers(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Заранее готовит ответы на все кнопки быстрых действий на текущий день"""
+    if not ANSWER_CACHE_ENABLED:
+        return
+
+    started = time.monotonic()
+    prompts = {
+        data: get_quick_action_prompt(data) for data in QUICK_ACTIONS
+        if not (data == "diary" and assistant.diary is not None)  # дневник отвечается локально
+    }
+    ok, failed = await assistant.prefetch_quick_answers(prompts)
+    logger.info(
+        f"Прогрев ответов на кнопки: готово {ok}, ошибок {failed} "
+        f"за {time.monotonic() - started:.1f} с"
+    )
+
+
+def schedule_warmup(application: Application) -> None:
+    """Регистрирует ежедневный прогрев кэша ответов и разовый прогрев после запуска"""
+    if not (WARMUP_ENABLED and ANSWER_CACHE_ENABLED):
+        return
+
+    if application.job_queue is None:
+        logger.warning("JobQueue недоступна (нужен python-telegram-bot[job-queue]), прогрев отключен")
+        return
+
+    hour, minute = (int(part) for part in WARMUP_TIME.split(":"))
+    application.job_queue.run_daily(
+        warmup_quick_answers,
+        time=datetime.now().replace(hour=hour, minute=minute, second=0, microsecond=0).astimezone().timetz(),
+        name="warmup_quick_answers"
+    )
+    application.job_queue.run_once(warmup_quick_answers, when=5, name="warmup_quick_answers_startup")
+    logger.info(f"Прогрев ответов на кнопки запланирован на {WARMUP_TIME}")
+
+
 # =====================================================================
 # ОБРАБОТЧИК ОШИБОК
 # =====================================================================
@@ -747,27 +3782,436 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
         logger.error(f"Не удалось отправить сообщение об ошибке: {str(e)}")
 
 
+# =====================================================================
+# ИСХОДЯЩИЕ ЗАПРОСЫ К TELEGRAM
+# =====================================================================
+
+class TokenBucket:
+    """Корзина токенов: rate запросов в секунду и не больше capacity подряд"""
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Занимает токен и возвращает, сколько секунд ждать его появления"""
+        self._refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """Пропускает все запросы бота через общую и початовые корзины токенов
+
+    Ожидание идет через asyncio.sleep, поэтому очереди к одному чату не мешают остальным.
+    На RetryAfter чат (или весь бот для запросов без чата) ставится на паузу,
+    а запрос повторяется; таймауты тоже повторяются с небольшой задержкой.
+    """
+    NO_RETRY = {"max_retries": 0}  # rate_limit_args для запросов, которые не жалко пропустить
+    MAX_CHAT_BUCKETS = 1024
+    UNLIMITED_ENDPOINTS = {"getUpdates"}  # длинный опрос сам себя ограничивает
+    CHAT_EXEMPT_ENDPOINTS = {"sendChatAction"}  # не тратит лимит сообщений чата
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, max_retries=TELEGRAM_SEND_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+        self.chat_buckets = {}
+        self.paused_until = {}  # chat_id (None — весь бот) -> time.monotonic()
+        self.max_retries = max_retries
+        self.requests = 0
+        self.delayed = 0
+        self.wait_seconds = 0.0
+        self.retry_after = 0
+        self.timeouts = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        logger.info(f"Статистика исходящих запросов Telegram: {self.as_dict()}")
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                # Полные корзины ничего не ограничивают, их можно забыть
+                self.chat_buckets = {key: b for key, b in self.chat_buckets.items() if not b.is_full()}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = TELEGRAM_GROUP_RATE if is_group else TELEGRAM_CHAT_RATE
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, TELEGRAM_CHAT_BURST)
+        return bucket
+
+    async def _wait(self, delay):
+        if delay > 0:
+            self.delayed += 1
+            self.wait_seconds += delay
+            await asyncio.sleep(delay)
+
+    async def _acquire(self, chat_id, endpoint):
+        await self._wait(self.paused_until.get(None, 0.0) - time.monotonic())
+        if chat_id is not None:
+            await self._wait(self.paused_until.get(chat_id, 0.0) - time.monotonic())
+            if endpoint not in self.CHAT_EXEMPT_ENDPOINTS:
+                await self._wait(self._chat_bucket(chat_id).reserve())
+        await self._wait(self.global_bucket.reserve())
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        with span(f"telegram.{endpoint}"):
+            return await self._process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
+
+    async def _process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in self.UNLIMITED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+
+        max_retries = (rate_limit_args or {}).get("max_retries", self.max_retries)
+        chat_id = data.get("chat_id")
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass  # None или @username канала
+
+        self.requests += 1
+        for attempt in range(max_retries + 1):
+            await self._acquire(chat_id, endpoint)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.retry_after += 1
+                delay = _retry_after_seconds(e)
+                self.paused_until[chat_id] = max(self.paused_until.get(chat_id, 0.0), time.monotonic() + delay)
+                if attempt == max_retries:
+                    raise
+                logger.warning(f"Telegram просит подождать {delay:.1f} с ({endpoint}, чат {chat_id})")
+            except TimedOut:
+                self.timeouts += 1
+                if attempt == max_retries:
+                    raise
+                logger.warning(f"Таймаут {endpoint}, повтор {attempt + 1}/{max_retries}")
+                await asyncio.sleep(0.5 * 2 ** attempt)
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "delayed": self.delayed,
+            "wait_seconds": round(self.wait_seconds, 2),
+            "retry_after": self.retry_after,
+            "timeouts": self.timeouts,
+        }
+
+
+# =====================================================================
+# ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА ОБНОВЛЕНИЙ
+# =====================================================================
+
+def get_update_user_key(update):
+    """Возвращает id пользователя (или чата), по которому упорядочиваются обновления"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает обновления разных пользователей параллельно, одного пользователя — по порядку
+
+    При latest_wins новое нажатие кнопки отменяет предыдущее нажатие того же пользователя,
+    ждет ли оно своей очереди или уже запрашивает Gemini.
+
+    Семафор базового класса берется до очереди пользователя, и серия сообщений одного
+    пользователя заняла бы все места. Поэтому базовому классу предел не ставится,
+    а свой семафор берется уже под замком пользователя.
+    """
+
+    def __init__(self, max_concurrent_updates, latest_wins=QUICK_ACTION_LATEST_WINS):
+        super().__init__(sys.maxsize)
+        self.semaphore = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self.latest_wins = latest_wins
+        self.locks = {}
+        self.waiters = {}
+        self.quick_actions = {}  # key -> задача последнего нажатия кнопки
+        self.superseded_tasks = set()
+        self.superseded = 0
+
+    async def do_process_update(self, update, coroutine):
+        key = get_update_user_key(update)
+        if key is None:
+            async with self.semaphore:
+                await coroutine
+        elif self.latest_wins and update.callback_query is not None:
+            await self._process_latest(key, update, coroutine)
+        else:
+            await self._process_in_order(key, coroutine)
+
+    async def _process_in_order(self, key, coroutine):
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        self.waiters[key] = self.waiters.get(key, 0) + 1
+        try:
+            async with lock, self.semaphore:
+                await coroutine
+        except asyncio.CancelledError:
+            coroutine.close()  # если отменили еще в очереди, обработчик так и не запускался
+            raise
+        finally:
+            self.waiters[key] -= 1
+            if not self.waiters[key]:
+                del self.waiters[key]
+                del self.locks[key]
+
+    async def _process_latest(self, key, update, coroutine):
+        previous = self.quick_actions.get(key)
+        if previous is not None and not previous.done():
+            self.superseded_tasks.add(previous)
+            previous.cancel()
+
+        task = self.quick_actions[key] = asyncio.create_task(self._process_in_order(key, coroutine))
+        try:
+            await task
+        except asyncio.CancelledError:
+            coroutine.close()  # задачу могли отменить до ее первого шага
+            if task not in self.superseded_tasks:
+                raise
+            self.superseded_tasks.discard(task)
+            self.superseded += 1
+            logger.info(f"Нажатие {update.callback_query.data} пользователя {key} отменено более новым")
+            try:
+                await update.callback_query.answer()  # убираем часики, если до ответа не дошло
+            except BadRequest:
+                pass
+        finally:
+            if self.quick_actions.get(key) is task:
+                del self.quick_actions[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+class WorkerPool:
+    """Раздает обновления рабочим процессам по user_id, сохраняя порядок для каждого пользователя"""
+
+    def __init__(self, workers):
+        context = multiprocessing.get_context("spawn")
+        self.queues = [context.Queue() for _ in range(workers)]
+        # Записи логов рабочих процессов пишет в файл этот процесс, чтобы ротация была одна
+        self.log_queue = context.Queue()
+        self.log_listener = logging.handlers.QueueListener(self.log_queue, *log_handlers)
+        self.processes = [
+            context.Process(
+                target=run_worker, args=(index, queue, workers, self.log_queue), name=f"bot-worker-{index}"
+            )
+            for index, queue in enumerate(self.queues)
+        ]
+
+    def start(self):
+        self.log_listener.start()
+        for process in self.processes:
+            process.start()
+        logger.info(f"Запущено рабочих процессов: {len(self.processes)}")
+
+    def dispatch(self, update):
+        key = get_update_user_key(update) or 0
+        self.queues[key % len(self.queues)].put(update.to_dict())
+
+    def stop(self, timeout=30):
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"Процесс {process.name} не завершился вовремя, останавливаем принудительно")
+                process.terminate()
+        logger.info("Рабочие процессы остановлены")
+        self.log_listener.stop()
+
+
+async def forward_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Передает обновление рабочему процессу вместо локальной обработки"""
+    context.application.bot_data["worker_pool"].dispatch(update)
+
+
+def run_worker(index, queue, workers=1, log_queue=None):
+    """Точка входа рабочего процесса: обрабатывает обновления из очереди своего шарда"""
+    if log_queue is not None:
+        logging.getLogger().handlers[:] = [create_queue_handler(log_queue)]
+    try:
+        asyncio.run(_worker_loop(index, queue, workers))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _worker_loop(index, queue, workers):
+    # Общие лимиты бота и Gemini делятся между процессами поровну
+    application = build_application(with_updater=False, rate_share=1 / workers)
+    assistant.admission.limit_share(1 / workers)
+    register_handlers(application)
+    if index == 0:
+        # Прогрев один на все процессы: иначе N одинаковых запросов к Gemini и запись в один файл
+        schedule_warmup(application)
+    application.bot_data["worker_index"] = index  # свой порт метрик у каждого процесса
+
+    await application.initialize()
+    await on_startup(application)
+    await application.start()
+    logger.info(f"Рабочий процесс {index} (pid {os.getpid()}) готов")
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        await application.stop()
+        await on_shutdown(application)
+        await application.shutdown()
+        logger.info(f"Рабочий процесс {index} завершен")
+
+
 # =====================================================================
 # ЗАПУСК БОТА
 # =====================================================================
 
+async def on_startup(application: Application) -> None:
+    """Подготавливает ресурсы ассистента при запуске приложения"""
+    await assistant.start()
+
+    if METRICS_ENABLED:
+        rate_limiter = application.bot.rate_limiter
+        if isinstance(rate_limiter, TelegramRateLimiter):
+            metrics.collectors.append(lambda: component_samples("telegram", rate_limiter))
+        port = METRICS_PORT + application.bot_data.get("worker_index", 0)
+        application.bot_data["metrics_server"] = await start_metrics_server(port)
+
+
+async def on_shutdown(application: Application) -> None:
+    """Освобождает ресурсы ассистента при остановке приложения"""
+    await assistant.close()
+    logger.info("HTTP-клиент Gemini закрыт")
+
+    server = application.bot_data.get("metrics_server")
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+
+
+async def on_front_shutdown(application: Application) -> None:
+    """Останавливает рабочие процессы вместе с принимающим процессом"""
+    await asyncio.to_thread(application.bot_data["worker_pool"].stop)
+
+
+def build_application(with_updater=True, post_init=None, post_shutdown=None, rate_share=1.0):
+    """Создает приложение с обработкой разных пользователей параллельно"""
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .base_url(f"{TELEGRAM_API_BASE}/bot")
+        .base_file_url(f"{TELEGRAM_API_BASE}/file/bot")
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+        .rate_limiter(TelegramRateLimiter(global_rate=TELEGRAM_GLOBAL_RATE * rate_share))
+    )
+    if not with_updater:
+        builder = builder.updater(None)
+    if post_init:
+        builder = builder.post_init(post_init)
+    if post_shutdown:
+        builder = builder.post_shutdown(post_shutdown)
+    return builder.build()
+
+
+def register_handlers(application):
+    # Добавляем обработчик ошибок
+    application.add_error_handler(error_handler)
+
+    # Регистрируем обработчики
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("test", test_command))
+    application.add_handler(CommandHandler("reset", reset_command))
+    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Telegram-бот нутрициолог")
+    parser.add_argument(
+        "--workers", type=int, default=BOT_WORKERS,
+        help="число рабочих процессов (1 — все в одном процессе)"
+    )
+    parser.add_argument(
+        "--mode", choices=["polling", "webhook"], default=BOT_MODE,
+        help="получать обновления опросом или через вебхук"
+    )
+    parser.add_argument("--listen", default=WEBHOOK_LISTEN, help="адрес HTTP-сервера вебхука")
+    parser.add_argument("--port", type=int, default=WEBHOOK_PORT, help="порт HTTP-сервера вебхука")
+    parser.add_argument("--webhook-url", default=WEBHOOK_URL, help="публичный адрес, на который Telegram шлет обновления")
+    return parser.parse_args()
+
+
+def run_webhook(application, args):
+    """Принимает обновления встроенным HTTP-сервером с проверкой секретного токена"""
+    if not args.webhook_url:
+        raise ValueError("Для режима webhook нужен публичный адрес: WEBHOOK_URL или --webhook-url")
+
+    secret_token = WEBHOOK_SECRET
+    if not secret_token:
+        secret_token = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET не задан, сгенерирован случайный секрет на время работы")
+
+    webhook_url = f"{args.webhook_url.rstrip('/')}/{WEBHOOK_PATH}"
+    logger.info(f"Вебхук: слушаем {args.listen}:{args.port}/{WEBHOOK_PATH}, публичный адрес {webhook_url}")
+
+    application.run_webhook(
+        listen=args.listen,
+        port=args.port,
+        url_path=WEBHOOK_PATH,
+        webhook_url=webhook_url,
+        secret_token=secret_token
+    )
+
+
 def main():
-    try:
-        logger.info("🚀 Запуск улучшенного бота...")
+    if not check_environment():
+        sys.exit(1)
 
-        # Создаем приложение
-        application = Application.builder().token(TELEGRAM_TOKEN).build()
+    logger.info("=" * 50)
+    logger.info("Начало работы бота")
+    logger.info(f"Токен Telegram: {TELEGRAM_TOKEN[:5]}...{TELEGRAM_TOKEN[-5:]}")
+    logger.info(f"Ключ Gemini: {GEMINI_API_KEY[:5]}...{GEMINI_API_KEY[-5:]}")
+    logger.info("=" * 50)
 
-        # Добавляем обработчик ошибок
-        application.add_error_handler(error_handler)
+    try:
+        args = parse_args()
+        logger.info("🚀 Запуск улучшенного бота...")
 
-        # Регистрируем обработчики
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("test", test_command))
-        application.add_handler(CommandHandler("reset", reset_command))
-        application.add_handler(CallbackQueryHandler(button_handler))
-        application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+        if args.workers > 1:
+            # Принимающий процесс только раздает обновления по рабочим процессам
+            worker_pool = WorkerPool(args.workers)
+            application = build_application(post_shutdown=on_front_shutdown)
+            application.bot_data["worker_pool"] = worker_pool
+            application.add_handler(TypeHandler(Update, forward_update))
+            worker_pool.start()
+        else:
+            # Создаем приложение
+            application = build_application(post_init=on_startup, post_shutdown=on_shutdown)
+            register_handlers(application)
+            schedule_warmup(application)
 
         logger.info("✅ Обработчики зарегистрированы")
         logger.info("🤖 Улучшенный бот запущен и ожидает сообщений...")
@@ -775,11 +4219,14 @@ def main():
         print("📸 Теперь поддерживается анализ фотографий еды!")
         print("🗓️ Рекомендации меняются каждый день!")
 
-        # Запускаем бота с уменьшенным таймаутом
-        application.run_polling(
-            poll_interval=0.5,
-            timeout=10
-        )
+        if args.mode == "webhook":
+            run_webhook(application, args)
+        else:
+            # Запускаем бота с уменьшенным таймаутом
+            application.run_polling(
+                poll_interval=0.5,
+                timeout=10
+            )
 
     except Exception as e:
         logger.critical(f"КРИТИЧЕСКАЯ ОШИБКА ПРИ ЗАПУСКЕ: {str(e)}", exc_info=True)